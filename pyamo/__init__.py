@@ -4,5 +4,6 @@
 # Portions Copyright (C) Philipp Kewisch, 2015
 
 from .service import AddonsService
+from .asyncservice import AsyncAddonsService
 
-__all__ = ['AddonsService']
+__all__ = ['AddonsService', 'AsyncAddonsService']
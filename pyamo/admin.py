@@ -4,14 +4,24 @@
 # Portions Copyright (C) Philipp Kewisch, 2017
 
 import time
+import hashlib
 
 from urllib.parse import urljoin
 import lxml.html
-import requests
 
 
+from .policy import PolicySession
 from .utils import AMO_BASE, AMO_ADMIN_BASE, AMO_EDITOR_BASE, AMO_REVIEWERS_API_BASE, \
-                   REV_ADDON_STATE, REV_ADDON_FILE_STATE, csspath
+                   REV_ADDON_STATE, REV_ADDON_FILE_STATE, Selectors, page_count
+
+SELECTORS = Selectors(
+    current_page=".pagination > li.selected > a",
+    pagelinks=".pagination > li > a[href*='page=']",
+    status='form > p > select > option[selected]',
+    token='form input[name="csrfmiddlewaretoken"]',
+    rows='form > table > tbody > tr',
+    selected_option='option[selected]'
+)
 
 
 class AdminUserInfoAddons:
@@ -49,7 +59,7 @@ class AdminRedashInfo:
     USER_QUERY_ID = 49910  # the query for all addons for a user
 
     def __init__(self, api_key, timeout=2):
-        self.session = requests.Session()
+        self.session = PolicySession()
         self.session.headers.update({'Authorization': 'Key {}'.format(api_key)})
 
         self.redash_url = 'https://sql.telemetry.mozilla.org'
@@ -104,6 +114,7 @@ class AdminInfo:
         self.versions = []
         self.addonstatus = -1
         self.page = 0
+        self.pagecount = None
         self.status = None
         self.token = None
 
@@ -125,11 +136,26 @@ class AdminInfo:
 
     def get_all_versions(self):
         self.versions = []
-        incomplete = True
+        self.page = 0
+        incomplete = self.get_next_page()
         while incomplete:
-            incomplete = self.get_next_page()
+            if self.pagecount is None:
+                # No pagination links, go page by page until we are past the last page
+                incomplete = self.get_next_page()
+                continue
+
+            # Fetch the remaining pages at once, later pages may link to more pages
+            pages = range(self.page + 1, self.pagecount + 1)
+            incomplete = len(pages) > 0
+            for page, doc in zip(pages, self.parent.page_map(self.fetch_admin_page, pages)):
+                incomplete = self.parse_admin_page(doc, page)
+                if not incomplete:
+                    break
 
     def get_admin_page(self, page=1):
+        return self.parse_admin_page(self.fetch_admin_page(page), page)
+
+    def fetch_admin_page(self, page):
         req = self.session.get(self.url + "?page=%d" % page, stream=True, allow_redirects=False)
 
         if req.status_code == 302:
@@ -147,30 +173,33 @@ class AdminInfo:
             req = self.session.get(righturl, stream=True, allow_redirects=False)
 
         req.raw.decode_content = True
-        doc = lxml.html.parse(req.raw).getroot()
+        return lxml.html.parse(req.raw).getroot()
 
-        first_page_path = ".pagination > li.selected > a"
-        first_page_node = doc.xpath(csspath(first_page_path))
+    def parse_admin_page(self, doc, page):
+        first_page_node = SELECTORS.current_page(doc)
         is_first_page = first_page_node[0].text == "1" if first_page_node else True
 
         if page > 1 and is_first_page:
             # We've gone over the last page, need to bail early
             return False
 
-        statusnode = doc.xpath(csspath('form > p > select > option[selected]'))[0]
-        tokennode = doc.xpath(csspath('form input[name="csrfmiddlewaretoken"]'))[0]
+        pagecount = page_count(SELECTORS.pagelinks(doc))
+        self.pagecount = max(pagecount, page) if pagecount else None
+
+        statusnode = SELECTORS.status(doc)[0]
+        tokennode = SELECTORS.token(doc)[0]
         self.status = int(statusnode.attrib['value'])
         self.token = tokennode.attrib['value']
 
         versions = []
         headrow = None
-        for row in doc.xpath(csspath('form > table > tbody > tr')):
+        for row in SELECTORS.rows(doc):
             if len(row.getchildren()) == 7:
                 headrow = row
 
             versions.append(AdminFile(self, row, headrow))
 
-        self.versions = self.versions + versions
+        self.versions.extend(versions)
         self.page = page
         return True
 
@@ -192,6 +221,16 @@ class AdminInfo:
     def all_versions(self):
         return [version.version for version in self.versions]
 
+    def file_hashes(self):
+        # File id to hash, e.g. "sha256:abc...", for Review.add_file_hashes. Hashes that can't be
+        # used to verify a download are left out.
+        hashes = {}
+        for version in self.versions:
+            algorithm, _, digest = (version.hash or "").partition(":")
+            if digest and algorithm in hashlib.algorithms_available:
+                hashes[str(version.fileid)] = version.hash
+        return hashes
+
     def formdata(self, changedonly=False):
         data = {
             'form-TOTAL_FORMS': len(self.versions),
@@ -244,7 +283,7 @@ class AdminFile:
         self.channel = channelcell.text
         self.fileid = int(filecell.getchildren()[0].text)
         self.platform = platformcell.text
-        self.status = int(statuscell.xpath(csspath('option[selected]'))[0].attrib['value'])
+        self.status = int(SELECTORS.selected_option(statuscell)[0].attrib['value'])
         self.originalstatus = self.status
 
         self.formid = statuscell.getchildren()[1].attrib['name'].split('-')[1]
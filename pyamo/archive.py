@@ -0,0 +1,111 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+# Portions Copyright (C) Philipp Kewisch, 2026
+
+import io
+import mmap
+import fnmatch
+import hashlib
+
+from zipfile import ZipFile
+
+
+class MappedFile(io.RawIOBase):
+    # A read-only file object over a memory mapped file, so ZipFile reads from the page cache
+    # without extra system calls.
+
+    def __init__(self, path):
+        super().__init__()
+        with open(path, 'rb') as fd:
+            self.mmap = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        with memoryview(self.mmap) as view, view[self.pos:self.pos + len(b)] as data:
+            size = len(data)
+            b[:size] = data
+        self.pos += size
+        return size
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += len(self.mmap)
+        self.pos = max(0, offset)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        if not self.closed:
+            self.mmap.close()
+        super().close()
+
+
+class XPIView:
+    # Random access to the files of an xpi without extracting it. Only the central directory is
+    # read when opening, members are decompressed when they are used.
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = MappedFile(path)
+        self.zipfile = ZipFile(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def __iter__(self):
+        return iter(self.list())
+
+    def __contains__(self, name):
+        return name in self.zipfile.NameToInfo
+
+    def close(self):
+        self.zipfile.close()
+        self.fd.close()
+
+    def list(self, pattern=None):
+        return [
+            info.filename for info in self.zipfile.infolist()
+            if not info.is_dir() and (not pattern or fnmatch.fnmatch(info.filename, pattern))
+        ]
+
+    def stat(self, name):
+        return self.zipfile.getinfo(name)
+
+    def open(self, name):
+        return self.zipfile.open(name)
+
+    def read(self, name):
+        return self.zipfile.read(name)
+
+    def hash(self, name, algorithm='sha256', chunksize=1024 * 1024):
+        hasher = hashlib.new(algorithm)
+        with self.open(name) as fd:
+            for chunk in iter(lambda: fd.read(chunksize), b''):
+                hasher.update(chunk)
+        return "%s:%s" % (algorithm, hasher.hexdigest())
+
+    def extract(self, name, targetpath):
+        return self.zipfile.extract(name, targetpath)
+
+    def extract_matching(self, patterns, targetpath):
+        names = [name for name in self.list()
+                 if any(fnmatch.fnmatch(name, pattern) for pattern in patterns)]
+        return [self.extract(name, targetpath) for name in names]
+
+    def extractall(self, targetpath):
+        self.zipfile.extractall(targetpath)
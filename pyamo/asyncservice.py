@@ -0,0 +1,82 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+# Portions Copyright (C) Philipp Kewisch, 2026
+
+import sys
+import asyncio
+import functools
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .service import AddonsService
+from .validation import ValidationReport
+from .utils import VALIDATION_WAIT, UPLOAD_PLATFORM
+
+DEFAULT_CONCURRENCY = 100
+
+
+class AsyncAddonsService:
+    # The requests run on a thread pool sharing the thread-safe AmoSession, so the parsing code in
+    # Review, AdminInfo, QueueEntry and friends is exactly the same as for AddonsService.
+
+    def __init__(self, login_prompter=None, concurrency=DEFAULT_CONCURRENCY, service=None):
+        self.service = service or AddonsService(login_prompter)
+        self.service.set_jobs(concurrency)
+        self.session = self.service.session
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    def persist(self):
+        self.service.persist()
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def get_review(self, id_or_url, unlisted=False, backend=None):
+        return await self._run(self.service.get_review, id_or_url, unlisted, backend)
+
+    async def get_admin_info(self, id_or_url, getall=True):
+        return await self._run(self.service.get_admin_info, id_or_url, getall)
+
+    async def get_queue(self, name_or_url):
+        return await self._run(self.service.get_queue, name_or_url)
+
+    async def get_logs(self, loglist, start=None, end=None, query=None, limit=sys.maxsize):
+        # pylint: disable=too-many-arguments
+        return await self._run(self.service.get_logs, loglist, start, end, query, limit)
+
+    async def upload(self, addonid, xpi, platform='all'):
+        if platform not in UPLOAD_PLATFORM:
+            raise Exception("Unknown platform %s" % platform)
+
+        uploadurl = await self._run(self.service.start_upload, addonid, xpi)
+        return await self.wait_for_validation(addonid, uploadurl, platform)
+
+    async def wait_for_validation(self, addonid, uploadurl, platform='all',
+                                  interval=VALIDATION_WAIT):
+        if platform not in UPLOAD_PLATFORM:
+            raise Exception("Unknown platform %s" % platform)
+
+        report = None
+        while not report or not report.completed:
+            req = await self._run(self.session.get, uploadurl, timeout=None)
+            report = ValidationReport(addonid, req.json(), platform)
+
+            if not report.success:
+                return report
+            elif not report.completed:
+                print("Waiting for validation...")
+                await asyncio.sleep(interval)
+
+        return report
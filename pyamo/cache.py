@@ -0,0 +1,267 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+# Portions Copyright (C) Philipp Kewisch, 2026
+
+import io
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+import requests
+
+from .utils import AMO_CONFIG, cachepath
+
+# Only pages matching one of these patterns are cached. The value is the number of seconds a
+# response is used without asking the server again, after that it is revalidated using the
+# ETag/Last-Modified validators. Can be overridden using the pyamo.cache.ttl config.
+DEFAULT_TTLS = {
+    r"/reviewers/review-(un)?listed/": 0,
+    r"/reviewers/(unlisted_)?queue/": 0,
+    r"/firefox/user/[^/]+/edit$": 3600,
+}
+
+DEFAULT_MAX_SIZE = 100 * 1024 * 1024
+
+# Pages with a form carry a CSRF token. These are never kept longer than the token is valid.
+DEFAULT_CSRF_LIFETIME = 3600
+
+# Developer emails rarely change, they are kept for a week
+DEFAULT_USER_TTL = 7 * 24 * 3600
+DEFAULT_USER_MAX_ENTRIES = 10000
+
+
+class CacheEntry:
+    def __init__(self, key, url, headers, body, stored, ttl, expires):
+        # pylint: disable=too-many-arguments
+        self.key = key
+        self.url = url
+        self.headers = headers
+        self.body = body
+        self.stored = stored
+        self.ttl = ttl
+        self.expires = expires
+
+    @property
+    def fresh(self):
+        return time.time() < self.stored + self.ttl
+
+    def validators(self):
+        headers = {}
+        if 'etag' in self.headers:
+            headers['If-None-Match'] = self.headers['etag']
+        if 'last-modified' in self.headers:
+            headers['If-Modified-Since'] = self.headers['last-modified']
+        return headers
+
+    def response(self, from_cache=True):
+        # pylint: disable=protected-access
+        resp = requests.Response()
+        resp.status_code = 200
+        resp.reason = "OK"
+        resp.url = self.url
+        resp.headers = requests.structures.CaseInsensitiveDict(self.headers)
+        resp.encoding = requests.utils.get_encoding_from_headers(resp.headers)
+        resp.raw = io.BytesIO(self.body)
+        resp._content = self.body
+        resp._content_consumed = True
+        resp.from_cache = from_cache
+        return resp
+
+
+class ResponseCache:
+    def __init__(self, path, ttls=None, max_size=DEFAULT_MAX_SIZE,
+                 csrf_lifetime=DEFAULT_CSRF_LIFETIME):
+        self.ttls = [(re.compile(pattern), ttl) for pattern, ttl in (ttls or DEFAULT_TTLS).items()]
+        self.max_size = max_size
+        self.csrf_lifetime = csrf_lifetime
+
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY, url TEXT, headers TEXT, body BLOB, size INTEGER,
+            stored REAL, accessed REAL, ttl REAL, expires REAL
+        )""")
+        self.conn.commit()
+
+    @staticmethod
+    def from_config():
+        if not AMO_CONFIG.get('pyamo', 'cache', 'enabled', fallback=True):
+            return None
+
+        ttls = dict(DEFAULT_TTLS)
+        ttls.update(AMO_CONFIG.get('pyamo', 'cache', 'ttl', fallback={}))
+
+        return ResponseCache(
+            cachepath("http.sqlite"), ttls,
+            max_size=AMO_CONFIG.get('pyamo', 'cache', 'max_size', fallback=DEFAULT_MAX_SIZE),
+            csrf_lifetime=AMO_CONFIG.get('pyamo', 'cache', 'csrf_lifetime',
+                                         fallback=DEFAULT_CSRF_LIFETIME)
+        )
+
+    def ttl(self, url):
+        for pattern, ttl in self.ttls:
+            if pattern.search(url):
+                return ttl
+        return None
+
+    @staticmethod
+    def key(user, url):
+        return hashlib.sha256(("%s\n%s" % (user, url)).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT url, headers, body, stored, ttl, expires FROM responses WHERE key = ?",
+                (key,)
+            ).fetchone()
+
+            if not row:
+                return None
+
+            url, headers, body, stored, ttl, expires = row
+            if expires and now > expires:
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.conn.commit()
+                return None
+
+            self.conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self.conn.commit()
+
+        return CacheEntry(key, url, json.loads(headers), body, stored, ttl, expires)
+
+    @staticmethod
+    def storable(ttl, resp):
+        # Without a ttl or a validator the entry could never be used again. This is decided from
+        # the headers, so responses that aren't stored can still be read as a stream.
+        return ttl > 0 or 'etag' in resp.headers or 'last-modified' in resp.headers
+
+    def delete(self, key):
+        with self.lock:
+            self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.conn.commit()
+
+    def store(self, key, ttl, resp):
+        body = resp.content
+        headers = {
+            name.lower(): value for name, value in resp.headers.items()
+            if name.lower() not in ('content-encoding', 'content-length', 'set-cookie')
+        }
+
+        now = time.time()
+        expires = None
+        if b'csrfmiddlewaretoken' in body:
+            expires = now + self.csrf_lifetime
+            ttl = min(ttl, self.csrf_lifetime)
+
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, resp.url, json.dumps(headers), body, len(body), now, now, ttl, expires)
+            )
+            self.evict()
+            self.conn.commit()
+
+        entry = CacheEntry(key, resp.url, headers, body, now, ttl, expires)
+        return entry.response(from_cache=False)
+
+    def refresh(self, entry):
+        # The server has confirmed the entry is still valid with a 304
+        with self.lock:
+            self.conn.execute("UPDATE responses SET stored = ? WHERE key = ?",
+                              (time.time(), entry.key))
+            self.conn.commit()
+        return entry.response()
+
+    def evict(self):
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_size:
+            return
+
+        rows = self.conn.execute("SELECT key, size FROM responses ORDER BY accessed ASC")
+        evict = []
+        for key, size in rows:
+            if total <= self.max_size:
+                break
+            evict.append((key,))
+            total -= size
+
+        self.conn.executemany("DELETE FROM responses WHERE key = ?", evict)
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM responses")
+            self.conn.commit()
+
+
+class UserCache:
+    # Emails of AMO users, looked up using the user edit page. Kept separately from the response
+    # cache so the (large) pages don't need to be stored or parsed again.
+
+    def __init__(self, path, ttl=DEFAULT_USER_TTL, max_entries=DEFAULT_USER_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS users (
+            userid TEXT PRIMARY KEY, email TEXT, stored REAL, accessed REAL
+        )""")
+        self.conn.commit()
+
+    @staticmethod
+    def from_config():
+        if not AMO_CONFIG.get('pyamo', 'cache', 'enabled', fallback=True):
+            return None
+
+        return UserCache(
+            cachepath("users.sqlite"),
+            ttl=AMO_CONFIG.get('pyamo', 'cache', 'users', 'ttl', fallback=DEFAULT_USER_TTL),
+            max_entries=AMO_CONFIG.get('pyamo', 'cache', 'users', 'max_entries',
+                                       fallback=DEFAULT_USER_MAX_ENTRIES)
+        )
+
+    def get(self, userid):
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT email FROM users WHERE userid = ? AND stored > ?",
+                (userid, now - self.ttl)
+            ).fetchone()
+
+            if not row:
+                return None
+
+            self.conn.execute("UPDATE users SET accessed = ? WHERE userid = ?", (now, userid))
+            self.conn.commit()
+
+        return row[0]
+
+    def store(self, userid, email):
+        now = time.time()
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?)",
+                              (userid, email, now, now))
+            self.evict(now)
+            self.conn.commit()
+
+    def evict(self, now):
+        self.conn.execute("DELETE FROM users WHERE stored <= ?", (now - self.ttl,))
+        self.conn.execute(
+            "DELETE FROM users WHERE userid NOT IN "
+            "(SELECT userid FROM users ORDER BY accessed DESC LIMIT ?)",
+            (self.max_entries,)
+        )
+
+    def invalidate(self, userids=None):
+        with self.lock:
+            if userids is None:
+                self.conn.execute("DELETE FROM users")
+            else:
+                self.conn.executemany("DELETE FROM users WHERE userid = ?",
+                                      [(userid,) for userid in userids])
+            self.conn.commit()
@@ -0,0 +1,197 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+# Portions Copyright (C) Philipp Kewisch, 2026
+
+import io
+import os
+import json
+import time
+import base64
+import hashlib
+import tempfile
+import datetime
+import threading
+import http.client
+
+from collections import defaultdict, deque
+
+import requests
+import urllib3
+
+# These describe the body on the wire, but recorded bodies are stored decoded
+SKIP_HEADERS = frozenset(('content-encoding', 'content-length', 'transfer-encoding'))
+
+# Larger bodies, e.g. downloads, are streamed to a file in a directory next to the cassette
+INLINE_BODY_SIZE = 256 * 1024
+BODY_CHUNK_SIZE = 1024 * 1024
+
+
+class CassetteMiss(requests.exceptions.RequestException):
+    pass
+
+
+class Cassette:
+    # Requests and responses of a command, one json object per line. Used to replay a command
+    # without network access, e.g. for benchmarking the parsing code.
+
+    def __init__(self, path, replay=False, latency=False):
+        self.path = path
+        self.bodydir = path + ".bodies"
+        self.replaying = replay
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.entries = defaultdict(deque)
+        self.fd = None
+
+        if replay:
+            with open(path) as fd:
+                for line in fd:
+                    entry = json.loads(line)
+                    self.entries[(entry['method'], entry['url'])].append(entry)
+        else:
+            self.fd = open(path, 'w')  # pylint: disable=consider-using-with
+
+    def close(self):
+        if self.fd:
+            self.fd.close()
+            self.fd = None
+
+    def save_body(self, raw):
+        # Returns the entry fields for the body, read in chunks so large bodies are never kept in
+        # memory as a whole
+        inline = bytearray()
+        hasher = hashlib.sha256()
+        fd = None
+        try:
+            for chunk in raw.stream(BODY_CHUNK_SIZE, decode_content=True):
+                hasher.update(chunk)
+                if fd:
+                    fd.write(chunk)
+                    continue
+
+                inline += chunk
+                if len(inline) > INLINE_BODY_SIZE:
+                    os.makedirs(self.bodydir, exist_ok=True)
+                    # pylint: disable=consider-using-with
+                    fd = tempfile.NamedTemporaryFile(dir=self.bodydir, delete=False)
+                    fd.write(inline)
+        except BaseException:
+            if fd:
+                fd.close()
+                os.unlink(fd.name)
+            raise
+
+        if not fd:
+            return {'body': base64.b64encode(inline).decode('ascii')}
+
+        fd.close()
+        name = hasher.hexdigest()
+        os.replace(fd.name, os.path.join(self.bodydir, name))
+        return {'bodyfile': name}
+
+    def open_body(self, entry):
+        # Returns a file object for the body and its length
+        if 'bodyfile' in entry:
+            path = os.path.join(self.bodydir, entry['bodyfile'])
+            return open(path, 'rb'), os.path.getsize(path)  # pylint: disable=consider-using-with
+
+        body = base64.b64decode(entry['body'])
+        return io.BytesIO(body), len(body)
+
+    def record(self, request, status, reason, headers, bodyfields, elapsed):
+        # pylint: disable=too-many-arguments
+        entry = {
+            'method': request.method,
+            'url': request.url,
+            'status': status,
+            'reason': reason,
+            'headers': [(name, value) for name, value in headers
+                        if name.lower() not in SKIP_HEADERS],
+            'elapsed': elapsed
+        }
+        entry.update(bodyfields)
+        with self.lock:
+            self.fd.write(json.dumps(entry) + "\n")
+            self.fd.flush()
+        return entry
+
+    def find(self, request):
+        with self.lock:
+            entries = self.entries.get((request.method, request.url))
+            if not entries:
+                raise CassetteMiss(
+                    "No recorded response for %s %s" % (request.method, request.url),
+                    request=request
+                )
+
+            # Repeated requests get the recorded responses in order, the last one is reused
+            return entries.popleft() if len(entries) > 1 else entries[0]
+
+
+class RecordedResponse:
+    # Stands in for the http.client response, requests reads the cookies from it
+
+    def __init__(self, method, headers):
+        self._method = method
+        self.msg = http.client.HTTPMessage()
+        for name, value in headers:
+            self.msg[name] = value
+
+    def close(self):
+        pass
+
+    @staticmethod
+    def isclosed():
+        return True
+
+
+def build_response(adapter, request, entry):
+    body, length = adapter.cassette.open_body(entry)
+    headers = entry['headers'] + [('Content-Length', str(length))]
+    raw = urllib3.HTTPResponse(
+        body=body,
+        headers=urllib3.response.HTTPHeaderDict(headers),
+        status=entry['status'],
+        reason=entry['reason'],
+        preload_content=False,
+        decode_content=False,
+        original_response=RecordedResponse(request.method, headers),
+        request_method=request.method,
+        request_url=request.url
+    )
+    resp = adapter.build_response(request, raw)
+    resp.elapsed = datetime.timedelta(seconds=entry['elapsed'])
+    return resp
+
+
+class RecordingAdapter(requests.adapters.HTTPAdapter):
+    def __init__(self, cassette, **kwargs):
+        self.cassette = cassette
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):  # pylint: disable=arguments-differ
+        start = time.monotonic()
+        resp = super().send(request, **kwargs)
+        try:
+            body = self.cassette.save_body(resp.raw)
+        finally:
+            resp.raw.release_conn()
+
+        entry = self.cassette.record(request, resp.status_code, resp.reason,
+                                     list(resp.raw.headers.iteritems()), body,
+                                     time.monotonic() - start)
+        return build_response(self, request, entry)
+
+
+class ReplayAdapter(requests.adapters.HTTPAdapter):
+    def __init__(self, cassette, **kwargs):
+        self.cassette = cassette
+        super().__init__(**kwargs)
+
+    def send(self, request, **_kwargs):  # pylint: disable=arguments-differ
+        # Nothing goes over the network, so timeouts and other connection options don't apply
+        entry = self.cassette.find(request)
+        if self.cassette.latency:
+            time.sleep(entry['elapsed'])
+        return build_response(self, request, entry)
@@ -19,9 +19,11 @@ import http.client
 
 from arghandler import subcmd, ArgumentHandler
 from .service import AddonsService
+from .stats import RequestStats
+from .cassette import Cassette
 from .utils import find_binary, runprofile, handler_defaults, ValidateFlags, \
                    requiresvpn, RE_VERSION, RE_VERSION_BETA, ADDON_STATE, ADDON_FILE_STATE, \
-                   REV_ADDON_STATE, REV_ADDON_FILE_STATE
+                   REV_ADDON_STATE, REV_ADDON_FILE_STATE, parallel_map
 
 DEFAULT_MESSAGE = {
     'confirm_auto_approved': '',
@@ -68,9 +70,11 @@ def cmd_debugtest(handler, amo, args):
         else:
             return val
 
-    for addon in args.addon:
+    def getflags(addon):
         review = amo.get_review(addon)
-        flags = review.flags(args.flags or {})
+        return review, review.flags(args.flags or {})
+
+    for addon, (review, flags) in zip(args.addon, amo.parallel_map(getflags, args.addon)):
         print("{} ({}, {} users)".format(addon, review.addonname, review.adu))
         if len(flags.keys()) > 0:
             print("\t" + "\n\t".join("{} = {}".format(key, mapvalue(value))
@@ -177,16 +181,19 @@ def cmd_admindisable(handler, amo, args):
         input()
         addons = args.addon
 
-    sys.stdout.write("Disabling...")
-    sys.stdout.flush()
-    for addon in addons:
-        review = amo.get_review(addon, unlisted=args.unlisted)
+    def disable(addon):
+        review = amo.get_review(addon, unlisted=args.unlisted, backend='html')
         success = True
         if args.message:
             versionids = review.get_enabled_version_numbers()
             success = review.decide("reject_multiple_versions", args.message, versionids=versionids)
 
-        if success and review.admin_disable():
+        return success and review.admin_disable()
+
+    sys.stdout.write("Disabling...")
+    sys.stdout.flush()
+    for addon, success in zip(addons, amo.parallel_map(disable, addons)):
+        if success:
             sys.stdout.write(".")
         else:
             sys.stdout.write("E(%s)" % addon)
@@ -314,6 +321,8 @@ def cmd_info(handler, amo, args):
                          help="Show developer emails for each add-on")
     handler.add_argument('--expand', action='store_true',
                          help="Show secondary information, e.g. developer emails")
+    handler.add_argument('--refresh', action='store_true',
+                         help="Look up developer emails again instead of using the cache")
     handler.add_argument('-f', '--files', action='store_true',
                          help='Show information about versions and files')
     handler.add_argument('-s', '--stats', action='store_true',
@@ -324,8 +333,14 @@ def cmd_info(handler, amo, args):
     adu_max = 0
     downloads_total = 0
 
-    for addon in args.addon:
-        review = amo.get_review(addon)
+    reviews = amo.parallel_map(amo.get_review, args.addon)
+    if args.developers and args.expand:
+        # Add-ons often share developers, look up each of them only once
+        reviews = list(reviews)
+        amo.expand_users((dev for review in reviews for dev in review.developers),
+                         refresh=args.refresh)
+
+    for review in reviews:
         print("%s (%s)" % (review.addonname, review.url))
         if args.developers:
             if args.expand:
@@ -407,6 +422,15 @@ def cmd_get(handler, amo, args):
                          help='Download all add-ons from a user')
     handler.add_argument('--symlinks', action="store_true",
                          help='Create symlinks for convenience. Works best as a default.')
+    handler.add_argument('-j', '--jobs', type=int, default=None,
+                         help='number of files to download in parallel, defaults to the global -j')
+    handler.add_argument('--lazy', action='store_true',
+                         help='only extract the manifest and files given with --member from xpis')
+    handler.add_argument('--member', action='append', default=[],
+                         help='with --lazy, also extract xpi files matching this pattern')
+    handler.add_argument('--hashes', action='store_true',
+                         help='verify downloads with the file hashes from the admin page. '
+                              'Requires admin access, works best as a default.')
     handler.add_argument('addon', nargs='+',
                          help='the addon id or url to get')
 
@@ -426,27 +450,40 @@ def cmd_get(handler, amo, args):
     if args.run:
         args.profile = True
 
+    if not args.jobs:
+        args.jobs = amo.jobs
+
     if args.user:
         pass
 
-    for addon in args.addon:
-        cmd_get_single(amo, args, addon)
+    addons = [resolve_addon_arg(addon) for addon in args.addon]
+    unlisted = args.unlisted
+    reviews = amo.parallel_map(lambda addon: amo.get_review(addon, unlisted), addons)
 
+    for addon, review in zip(addons, reviews):
+        cmd_get_single(amo, args, addon, review, unlisted)
 
-def cmd_get_single(amo, args, addon):
+
+def resolve_addon_arg(addon):
     if addon == '.':
         addon = os.path.basename(os.getcwd())
         if RE_VERSION.search(addon):
             addon = os.path.basename(os.path.dirname(os.getcwd()))
+    return addon
+
+
+def cmd_get_single(amo, args, addon, review=None, unlisted=False):
+    addon = resolve_addon_arg(addon)
 
     if len(args.addon) > 1:
         print("Getting add-on %s" % addon)
 
-    review = amo.get_review(addon, args.unlisted)
-    if len(review.versions) == 0:
+    # The reviews of other add-ons may still be loading, so the fallback to unlisted is only for
+    # this add-on and leaves args alone.
+    review = review or amo.get_review(addon, unlisted)
+    if len(review.versions) == 0 and not unlisted:
         print("Warning: No listed versions, trying unlisted")
-        args.unlisted = True
-        review = amo.get_review(addon, args.unlisted)
+        review = amo.get_review(addon, True)
 
     addonpath = os.path.join(args.outdir, review.slug)
     cmdpath = os.path.join(args.outdir, addon)
@@ -487,11 +524,11 @@ def cmd_get_single(amo, args, addon):
             replace_version_tag(argversions,
                                 "previous",
                                 review.find_previous_version, quiet=True)
-            argmatch = [v for v in versions if v.version in argversions]
-            argidmatch = [v for v in versions if v.id in argversionids]
+            argmatch = [versions.by_version(v) for v in argversions]
+            argidmatch = [versions.by_id(v) for v in argversionids]
 
-            if len(argmatch) + len(argidmatch) == len(argversions) + len(argversionids):
-                return argmatch + argidmatch
+            if all(argmatch) and all(argidmatch):
+                return versions.sort(argmatch) + versions.sort(argidmatch)
             else:
                 print("Warning: could not find all requested version on page",
                       "%d, trying next page" % page)
@@ -506,29 +543,65 @@ def cmd_get_single(amo, args, addon):
         print("Error: no requested versions found")
         return
 
-    for version in versions:
-        platforms = ", ".join(version.apps)
-        print('Getting version %s %s [%s]' % (review.slug, version.version, platforms))
-        for fileobj in version.files:
-            fileplatforms = ", ".join(fileobj.platforms)
-            print('\tGetting file %s [%s]' % (fileobj.filename, fileplatforms))
-            fileobj.save(addonpath)
-            fileobj.extract(addonpath)
-            if args.profile:
-                print('\tCreating profile [%s]' % fileplatforms)
-                fileobj.createprofile(addonpath)
+    if args.hashes and not review.load_file_hashes(versions):
+        print("Warning: could not get file hashes from the admin page, downloads are not verified")
 
+    def getfile(fileobj):
+        fileplatforms = ", ".join(fileobj.platforms)
+        lines = ['\tGetting file %s [%s]' % (fileobj.filename, fileplatforms)]
+        fileobj.save(addonpath)
+        fileobj.extract(addonpath, ["manifest.json"] + args.member if args.lazy else None)
+        if args.profile:
+            lines.append('\tCreating profile [%s]' % fileplatforms)
+            fileobj.createprofile(addonpath)
+        return lines
+
+    def getsources(version):
+        version.extractsources(addonpath)
+        return ['\tGetting sources ' + version.sourcefilename]
+
+    # Each file is extracted as soon as it is downloaded, while the other downloads continue. The
+    # results are printed in order, the same way as when running one at a time. A failed task
+    # doesn't stop the others.
+    tasks = []
+    for version in versions:
+        tasks.extend((version, 'file ' + fileobj.filename, getfile, fileobj)
+                     for fileobj in version.files)
         if version.sources:
-            sys.stdout.write('\tGetting sources')
+            tasks.append((version, 'sources', getsources, version))
 
-            version.savesources(addonpath)
-            print(' ' + version.sourcefilename)
-            version.extractsources(addonpath)
-
-        if args.symlinks:
+    def runtask(task):
+        _, label, func, arg = task
+        try:
+            return func(arg), None
+        except Exception as e:  # pylint: disable=broad-except
+            return [], "\tError getting %s: %s" % (label, e)
+
+    current = None
+    failed = []
+    results = parallel_map(runtask, tasks, args.jobs)
+    for (version, _, _, _), (lines, error) in zip(tasks, results):
+        if version is not current:
+            platforms = ", ".join(version.apps)
+            print('Getting version %s %s [%s]' % (review.slug, version.version, platforms))
+            current = version
+
+        if error:
+            lines = [error]
+            if version not in failed:
+                failed.append(version)
+        print("\n".join(lines))
+
+    if failed:
+        print("Error: could not get all files of version %s" %
+              ", ".join(version.version for version in failed))
+        versions = [version for version in versions if version not in failed]
+
+    if args.symlinks:
+        for version in versions:
             version.linklatest(addonpath)
 
-    if args.run:
+    if args.run and versions:
         print('Running applicaton for %s %s' % (review.slug, versions[-1].version))
         if not args.binary:
             print("Warning: you should be running unreviewed extensions in a VM for safety")
@@ -634,14 +707,12 @@ def cmd_decide(handler, amo, args):
             print("Will give %s review to %s in 3 seconds" % (args.action, args.addon[0]))
         time.sleep(3)
 
-    failures = []
-
-    for addon in args.addon:
-        review = amo.get_review(addon.strip(), unlisted=args.unlisted)
+    def decide(addon):
+        review = amo.get_review(addon.strip(), unlisted=args.unlisted, backend='html')
         if args.action not in review.actions:
             actions = ",".join(review.actions)
-            print("Error: Action not valid for reviewing %s (%s)" % (review.addonname, actions))
-            continue
+            message = "Error: Action not valid for reviewing %s (%s)" % (review.addonname, actions)
+            return message, True
 
         if args.all:
             success = review.decide(args.action, args.message, review.versions)
@@ -651,14 +722,18 @@ def cmd_decide(handler, amo, args):
         else:
             success = review.decide(args.action, args.message, [review.versions[-1]])
 
+        if success and args.undelay:
+            success = review.remove_extra_delay()
+
+        return "%s completed" % addon, success
+
+    failures = []
+
+    for addon, (message, success) in zip(args.addon, amo.parallel_map(decide, args.addon)):
         if not success:
             failures.append(addon)
-        elif args.undelay:
-            success = review.remove_extra_delay()
-            if not success:
-                failures.append(addon)
 
-        print("%s completed" % addon)
+        print(message)
 
     if len(failures) > 0:
         print("The following add-ons failed:\n\t" + "\n\t".join(failures))
@@ -792,6 +867,7 @@ def login_prompter_impl(mode="login"):
 def main():
     amo = AddonsService(login_prompter=login_prompter_impl)
     cookiedefault = os.path.expanduser('~/.amo_cookie')
+    stats = RequestStats()
 
     def load_context(args):
         if args.profile:
@@ -800,6 +876,17 @@ def main():
             amo.session.load(args.cookies)
 
         amo.session.timeout = args.timeout
+        amo.set_jobs(args.jobs)
+        if args.no_cache or args.record or args.replay:
+            # A recording needs to contain every request, and replays must only come from there
+            amo.session.cache = None
+            amo.session.usercache = None
+        if args.stats:
+            stats.attach(amo.session)
+        if args.record:
+            amo.session.use_cassette(Cassette(args.record))
+        elif args.replay:
+            amo.session.use_cassette(Cassette(args.replay, replay=True, latency=args.latency))
         return amo
 
     handler = ArgumentHandler(use_subcommand_help=True)
@@ -811,6 +898,20 @@ def main():
 
     handler.add_argument('--timeout', type=int, default=None,
                          help='timeout for http requests')
+    handler.add_argument('-j', '--jobs', type=int, default=1,
+                         help='number of add-ons to process in parallel for bulk commands')
+    handler.add_argument('--no-cache', action='store_true',
+                         help='do not use the response cache for review, user and queue pages')
+    handler.add_argument('--stats', action='store_true',
+                         help='print request statistics per endpoint when done')
+
+    cassettegroup = handler.add_mutually_exclusive_group()
+    cassettegroup.add_argument('--record', metavar='FILE',
+                               help='record all requests and responses to this file')
+    cassettegroup.add_argument('--replay', metavar='FILE',
+                               help='replay requests from a recorded file without network access')
+    handler.add_argument('--latency', action='store_true',
+                         help='when replaying, wait as long as the recorded request took')
     handler.set_logging_argument('-d', '--debug', default_level=logging.WARNING,
                                  config_fxn=init_logging)
 
@@ -821,6 +922,10 @@ def main():
         amo.persist()
     except KeyboardInterrupt:
         pass
+    finally:
+        if amo.session.cassette:
+            amo.session.cassette.close()
+        stats.print_summary()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,503 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+# Portions Copyright (C) Philipp Kewisch, 2026
+
+import os
+import re
+import json
+import time
+import errno
+import queue
+import shutil
+import hashlib
+import threading
+
+import requests
+import urllib3
+
+from .utils import AMO_CONFIG, FileLock, cachepath, write_json_atomic
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl to share the blocks of a file on copy-on-write filesystems like btrfs and xfs
+FICLONE = 0x40049409
+
+# The headers needed to pick the file name again when a download is skipped
+NAME_HEADERS = ('content-type', 'content-disposition')
+
+RE_CONTENT_RANGE = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)')
+
+
+# Chunks grow up to this size while downloading, aiming for about CHUNK_SECONDS of data each
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+CHUNK_SECONDS = 0.05
+WRITE_BUFFERS = 4
+
+
+class HashMismatch(Exception):
+    pass
+
+
+class FileWriter:
+    # Writes and hashes the chunks on a separate thread, so the connection is read while the disk
+    # is busy. The chunks are read into a few reusable buffers instead of new bytes objects. The
+    # buffers are only allocated when the previous ones are all in use.
+
+    def __init__(self, fd, hasher, bufsize=MAX_CHUNK_SIZE):
+        self.fd = fd
+        self.hasher = hasher
+        self.bufsize = bufsize
+        self.written = 0
+        self.error = None
+        self.allocated = 0
+        self.free = queue.Queue()
+        self.pending = queue.Queue()
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+
+            buf, size = item
+            try:
+                if not self.error:
+                    view = memoryview(buf)[:size]
+                    self.hasher.update(view)
+                    self.fd.write(view)
+                    self.written += size
+            except Exception as e:  # pylint: disable=broad-except
+                self.error = e
+            finally:
+                self.free.put(buf)
+
+    def buffer(self):
+        if self.error:
+            raise self.error
+
+        if self.free.empty() and self.allocated < WRITE_BUFFERS:
+            self.allocated += 1
+            return bytearray(self.bufsize)
+        return self.free.get()
+
+    def release(self, buf):
+        self.free.put(buf)
+
+    def write(self, buf, size):
+        self.pending.put((buf, size))
+
+    def close(self):
+        self.pending.put(None)
+        self.thread.join()
+        if self.error:
+            raise self.error
+
+
+def adapt_chunksize(chunksize, count, elapsed, minimum, maximum=MAX_CHUNK_SIZE):
+    # Double or halve the chunk size depending on how fast the last chunk arrived
+    # pylint: disable=too-many-arguments
+    if count == chunksize and elapsed < CHUNK_SECONDS / 2:
+        return min(chunksize * 2, maximum)
+    elif elapsed > CHUNK_SECONDS * 2:
+        return max(chunksize // 2, minimum)
+    return chunksize
+
+
+def read_into(resp, buf):
+    # Reads the body through urllib3 and raises the same exceptions as requests' iter_content, so
+    # callers can handle timeouts and dropped connections the same way
+    try:
+        return resp.raw.readinto(buf)
+    except urllib3.exceptions.ProtocolError as e:
+        raise requests.exceptions.ChunkedEncodingError(e) from e
+    except urllib3.exceptions.ReadTimeoutError as e:
+        raise requests.exceptions.ConnectionError(e) from e
+    except urllib3.exceptions.SSLError as e:
+        raise requests.exceptions.SSLError(e) from e
+
+
+def preallocate(fd, offset, length):
+    if length and length > offset and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd.fileno(), offset, length - offset)
+        except OSError:
+            # Not all filesystems support it, the file just grows while writing then
+            pass
+
+
+class StreamHash:
+    # Hashes a file while it is written. The result uses the AMO format, e.g. "sha256:abc...".
+    # If the expected hash uses a different algorithm, it is calculated as well. The data is also
+    # passed on to the consumer, if given, e.g. to extract the file while it is downloaded.
+
+    def __init__(self, expected=None, consumer=None):
+        self.expected = expected
+        self.consumer = consumer
+        self.hashes = {'sha256': hashlib.sha256()}
+        if expected:
+            algorithm = expected.partition(":")[0]
+            self.hashes.setdefault(algorithm, hashlib.new(algorithm))
+
+    def update(self, data):
+        for hasher in self.hashes.values():
+            hasher.update(data)
+        if self.consumer:
+            self.consumer.feed(data)
+
+    def update_file(self, path, size=None, chunksize=1024 * 1024):
+        with open(path, 'rb') as fd:
+            remaining = size if size is not None else -1
+            while remaining:
+                data = fd.read(chunksize if remaining < 0 else min(chunksize, remaining))
+                if not data:
+                    break
+                self.update(data)
+                remaining -= len(data)
+
+    def digests(self):
+        return {name: "%s:%s" % (name, hasher.hexdigest()) for name, hasher in self.hashes.items()}
+
+
+def check_hash(digests, expected):
+    if expected and digests.get(expected.partition(":")[0]) != expected:
+        raise HashMismatch("Expected hash %s, got %s" % (
+            expected, digests.get(expected.partition(":")[0])
+        ))
+
+
+class Download:
+    # Saves a file to a directory. The file is written to a .part file first and renamed when
+    # complete. A hidden state file next to it records the validators, so an interrupted download
+    # continues where it stopped and a complete file is not downloaded again.
+
+    def __init__(self, session, url, directory, shared=False):
+        # A shared download is the same file whichever url it comes from, e.g. a blob keyed by its
+        # hash. It keeps one state file in the directory, regardless of the url.
+        self.session = session
+        self.url = url
+        self.directory = directory
+        self.shared = shared
+        if shared:
+            self.statepath = os.path.join(directory, ".download.json")
+        else:
+            self.statepath = os.path.join(
+                directory,
+                ".download-%s.json" % hashlib.sha1(url.encode("utf-8")).hexdigest()[:16]
+            )
+        self.state = self.load()
+        self.path = self.state.get('path')
+        self.skipped = False
+
+    def load(self):
+        try:
+            with open(self.statepath) as fd:
+                state = json.load(fd)
+        except (IOError, ValueError):
+            return {}
+
+        return state if self.shared or state.get('url') == self.url else {}
+
+    def persist(self):
+        write_json_atomic(self.statepath, self.state)
+
+    @property
+    def complete(self):
+        if not self.state.get('complete') or not self.path or not os.path.exists(self.path):
+            return False
+
+        # A file that was changed after downloading, e.g. through a hardlink, is downloaded again
+        stat = os.stat(self.path)
+        return stat.st_size == self.state.get('length') and \
+            self.state.get('mtime', stat.st_mtime_ns) == stat.st_mtime_ns
+
+    def validator(self):
+        # Weak etags can't be used for range requests
+        etag = self.state.get('etag')
+        if etag and not etag.startswith('W/'):
+            return etag
+        return self.state.get('last_modified')
+
+    def request(self, offset=0):
+        # Ask for the raw file, ranges don't work on content-encoded bodies
+        headers = {'Accept-Encoding': 'identity'}
+
+        if self.complete:
+            if self.state.get('etag'):
+                headers['If-None-Match'] = self.state['etag']
+            if self.state.get('last_modified'):
+                headers['If-Modified-Since'] = self.state['last_modified']
+        elif offset:
+            headers['Range'] = 'bytes=%d-' % offset
+            headers['If-Range'] = self.validator()
+
+        try:
+            return self.session.get(self.url, stream=True, headers=headers)
+        except requests.exceptions.HTTPError as e:
+            if offset and e.response.status_code == 416:
+                # The partial file doesn't match anymore, start over
+                return self.request()
+            raise
+
+    def unchanged(self, resp):
+        state = self.state
+        return self.complete and resp.status_code == 200 and \
+            resp.headers.get('content-length') == str(state.get('length')) and \
+            resp.headers.get('etag') == state.get('etag') and \
+            resp.headers.get('last-modified') == state.get('last_modified')
+
+    @staticmethod
+    def write_body(resp, fd, hasher, chunksize, length=None):
+        # pylint: disable=too-many-arguments
+        if resp.headers.get('content-encoding', 'identity') != 'identity':
+            written = 0
+            for chunk in resp.iter_content(chunksize):
+                hasher.update(chunk)
+                fd.write(chunk)
+                written += len(chunk)
+            return written
+
+        offset = fd.tell()
+        preallocate(fd, offset, length)
+
+        # Small files don't need the full size buffers
+        bufsize = MAX_CHUNK_SIZE
+        if length is not None:
+            bufsize = max(min(MAX_CHUNK_SIZE, length - offset), chunksize, 1)
+
+        writer = FileWriter(fd, hasher, bufsize)
+        size = min(chunksize, bufsize)
+        try:
+            while True:
+                buf = writer.buffer()
+                start = time.monotonic()
+                count = read_into(resp, memoryview(buf)[:size])
+                if not count:
+                    writer.release(buf)
+                    break
+
+                writer.write(buf, count)
+                size = adapt_chunksize(size, count, time.monotonic() - start, chunksize, bufsize)
+        except BaseException:
+            # The connection is in an unknown state, don't return it to the pool
+            resp.close()
+            raise
+        finally:
+            writer.close()
+
+        resp.raw.release_conn()
+        return writer.written
+
+    @property
+    def hash(self):
+        return self.state.get('hashes', {}).get('sha256')
+
+    def skip(self, namefunc, expected_hash):
+        hashes = self.state.setdefault('hashes', {})
+        algorithm = expected_hash.partition(":")[0] if expected_hash else 'sha256'
+        if algorithm not in hashes:
+            # Files saved before hashes were recorded, or checked with a different algorithm
+            hasher = StreamHash(expected_hash)
+            hasher.update_file(self.path)
+            hashes.update(hasher.digests())
+            self.persist()
+
+        check_hash(hashes, expected_hash)
+        self.skipped = True
+        return namefunc(self.state['headers'])
+
+    def discard(self):
+        for path in (self.path, self.statepath):
+            if path and os.path.exists(path):
+                os.unlink(path)
+        self.state = {}
+        self.path = None
+
+    def save(self, namefunc, chunksize=16384, revalidate=True, expected_hash=None,
+             consumer=None):
+        # namefunc gets the response headers and returns the path to save the file to. Complete
+        # files that can't change are only checked with the server if revalidate is set. The
+        # file is hashed while downloading and checked against expected_hash, if given. The
+        # consumer's feed() gets the file from the start when it is downloaded, it is not
+        # called if the file was complete already.
+        # pylint: disable=too-many-arguments
+        os.makedirs(self.directory, exist_ok=True)
+
+        if not revalidate and self.complete:
+            try:
+                return self.skip(namefunc, expected_hash)
+            except HashMismatch:
+                # The file was changed after downloading, get it again
+                self.discard()
+
+        offset = 0
+        partpath = self.path + ".part" if self.path else None
+        if not self.complete and partpath and os.path.exists(partpath) and self.validator():
+            offset = os.path.getsize(partpath)
+
+        resp = self.request(offset)
+        if resp.status_code == 304 or self.unchanged(resp):
+            resp.close()
+            return self.skip(namefunc, expected_hash)
+
+        path = namefunc(resp.headers)
+        if partpath and partpath != path + ".part" and os.path.exists(partpath):
+            os.unlink(partpath)
+        partpath = path + ".part"
+
+        length = resp.headers.get('content-length')
+        length = int(length) if length else None
+        match = RE_CONTENT_RANGE.match(resp.headers.get('content-range', ''))
+        if resp.status_code == 206 and match and int(match.group(1)) == offset:
+            length = int(match.group(3)) if match.group(3) != '*' else None
+        else:
+            offset = 0
+
+        self.path = path
+        self.state = {
+            'url': self.url,
+            'path': path,
+            'etag': resp.headers.get('etag'),
+            'last_modified': resp.headers.get('last-modified'),
+            'length': length,
+            'headers': {name: resp.headers[name] for name in NAME_HEADERS if name in resp.headers},
+            'complete': False
+        }
+        self.persist()
+
+        hasher = StreamHash(expected_hash, consumer)
+        if offset:
+            # Only the part that was already downloaded needs to be read again
+            hasher.update_file(partpath, offset)
+
+        with open(partpath, 'r+b' if offset else 'wb') as fd:
+            fd.seek(offset)
+            fd.truncate()
+            try:
+                size = offset + self.write_body(resp, fd, hasher, chunksize, length)
+            finally:
+                # Remove the preallocated space after the last byte written, so the next attempt
+                # resumes at the right position
+                fd.truncate()
+
+        if length is not None and size != length:
+            raise requests.exceptions.ChunkedEncodingError(
+                "Download of %s incomplete (%d of %d bytes)" % (self.url, size, length)
+            )
+
+        digests = hasher.digests()
+        try:
+            check_hash(digests, expected_hash)
+        except HashMismatch:
+            os.unlink(partpath)
+            os.unlink(self.statepath)
+            raise
+
+        os.replace(partpath, path)
+        self.state['length'] = size
+        self.state['mtime'] = os.stat(path).st_mtime_ns
+        self.state['hashes'] = digests
+        self.state['complete'] = True
+        self.persist()
+        return path
+
+
+def link_file(source, target):
+    # Clones the file on copy-on-write filesystems like btrfs and xfs, otherwise hardlinks it, or
+    # copies it as a last resort. Changes to a hardlinked file also change the source, these are
+    # noticed by Download.complete. The target is replaced atomically, so readers never see a
+    # partial file.
+    if os.path.exists(target) and os.path.samefile(source, target):
+        return
+
+    temppath = "%s.%d.tmp" % (target, os.getpid())
+    try:
+        if not clone_file(source, temppath):
+            try:
+                os.link(source, temppath)
+            except OSError:
+                shutil.copyfile(source, temppath)
+        os.replace(temppath, target)
+    except BaseException:
+        if os.path.exists(temppath):
+            os.unlink(temppath)
+        raise
+
+
+def clone_file(source, target):
+    # Returns False if the file can't be cloned
+    if not fcntl:
+        return False
+
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return True
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTTY):
+                raise
+
+    os.unlink(target)
+    return False
+
+
+class BlobStore:
+    # Downloaded files are kept once in the cache directory and linked into the output directory.
+    # Files are keyed by their hash if known, otherwise by the AMO file id, so the same file is
+    # shared between platforms, channels and output directories. A lock per blob makes sure
+    # parallel processes don't download the same file twice.
+
+    def __init__(self, path):
+        self.path = path
+
+    @staticmethod
+    def from_config():
+        if not AMO_CONFIG.get('pyamo', 'blobs', 'enabled', fallback=True):
+            return None
+
+        path = AMO_CONFIG.get('pyamo', 'blobs', 'path', fallback=None)
+        return BlobStore(os.path.expanduser(path) if path else cachepath("blobs"))
+
+    @staticmethod
+    def key(fileid=None, filehash=None, url=None):
+        if filehash:
+            return filehash.replace(":", "-")
+        elif fileid:
+            return "file-%s" % fileid
+        else:
+            return "url-%s" % hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+    def fetch(self, session, url, key, namefunc, chunksize=16384, revalidate=False,
+              expected_hash=None, consumer=None):
+        # pylint: disable=too-many-arguments
+        blobdir = os.path.join(self.path, key[:2], key)
+        os.makedirs(blobdir, exist_ok=True)
+
+        with FileLock(os.path.join(blobdir, ".lock")):
+            download = Download(session, url, blobdir, shared=True)
+            blobpath = download.save(lambda headers: os.path.join(blobdir, "blob"), chunksize,
+                                     revalidate, expected_hash, consumer)
+
+        target = namefunc(download.state['headers'])
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        link_file(blobpath, target)
+        return target, download.hash
+
+
+def fetch(session, url, directory, namefunc, chunksize=16384, key=None, revalidate=True,
+          expected_hash=None, consumer=None):
+    # Returns the path the file was saved to and its sha256 hash
+    # pylint: disable=too-many-arguments
+    if session.blobs and key:
+        return session.blobs.fetch(session, url, key, namefunc, chunksize, revalidate,
+                                   expected_hash, consumer)
+
+    download = Download(session, url, directory)
+    path = download.save(namefunc, chunksize, revalidate, expected_hash, consumer)
+    return path, download.hash
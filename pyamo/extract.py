@@ -0,0 +1,435 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+# Portions Copyright (C) Philipp Kewisch, 2026
+
+import os
+import json
+import time
+import shutil
+import queue
+import fnmatch
+import tarfile
+import threading
+
+from zipfile import ZipFile
+
+from .archive import MappedFile
+from .lzma import SevenZFile
+from .utils import AMO_CONFIG, parallel_map, write_json_atomic
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Archives inside of archives can be extracted next to them, into a directory with this suffix
+NESTED_SUFFIX = ".extracted"
+NESTED_DEPTH = AMO_CONFIG.get('pyamo', 'extract', 'nested_depth', fallback=0)
+
+EXTRACT_JOBS = AMO_CONFIG.get('pyamo', 'extract', 'jobs', fallback=4)
+
+# Enough of the start of a file to find the tar header magic
+SNIFF_SIZE = 512
+
+# Chunks waiting to be extracted while downloading, the download waits when the queue is full
+STREAM_CHUNKS = 16
+
+# Reading a stream to the end is done in pieces of this size
+MAX_READ = 1024 * 1024
+
+EXTRACTORS = {}
+STREAM_EXTRACTORS = {}
+MIME_TYPES = {}
+EXTENSIONS = {}
+SIGNATURES = []
+
+
+def safe_path(root, name):
+    # The path to extract a member to, or None if it would end up outside of the root
+    path = os.path.realpath(os.path.join(root, name))
+    if path.startswith(os.path.realpath(root) + os.sep):
+        return path
+    return None
+
+
+class ExtractManifest:
+    # Records the archive and the size, CRC and mtime of each member extracted from it, in a hidden
+    # file next to the extracted directory. A later extraction of the same archive is skipped, and
+    # a changed archive only rewrites the members that are different.
+
+    def __init__(self, extractpath):
+        self.extractpath = extractpath
+        self.path = ExtractManifest.manifestpath(extractpath)
+        self.archive = None
+        self.complete = False
+        self.members = {}
+        self.extracted = {}
+
+        try:
+            with open(self.path) as fd:
+                data = json.load(fd)
+            self.archive = data['archive']
+            self.complete = data['complete']
+            self.members = data['members']
+        except (IOError, ValueError, KeyError):
+            pass
+
+    @staticmethod
+    def manifestpath(extractpath):
+        return os.path.join(os.path.dirname(extractpath),
+                            "." + os.path.basename(extractpath) + ".manifest.json")
+
+    @staticmethod
+    def identify(archivepath, archivehash=None):
+        stat = os.stat(archivepath)
+        return {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': archivehash}
+
+    def same_archive(self, identity):
+        if not self.archive or not self.complete:
+            return False
+        elif identity['hash'] and self.archive.get('hash'):
+            return identity['hash'] == self.archive['hash']
+        return identity['size'] == self.archive['size'] and \
+            identity['mtime'] == self.archive['mtime']
+
+    def on_disk(self, name, entry):
+        # The file was not removed or changed since it was extracted
+        try:
+            stat = os.stat(os.path.join(self.extractpath, name))
+        except OSError:
+            return False
+        return stat.st_size == entry['size'] and int(stat.st_mtime) == int(entry['mtime'])
+
+    def unchanged(self, name, size, mtime, crc=None):
+        entry = self.members.get(name)
+        if not entry or entry['size'] != size or int(entry['mtime']) != int(mtime):
+            return False
+        if crc is not None and entry.get('crc') is not None and entry['crc'] != crc:
+            return False
+        if not self.on_disk(name, entry):
+            return False
+
+        self.extracted[name] = entry
+        return True
+
+    def record(self, name, size, mtime, crc=None):
+        self.extracted[name] = {'size': size, 'mtime': mtime, 'crc': crc}
+
+    def save(self, identity, complete=True):
+        if complete:
+            # Remove files that are no longer in the archive, and anything extracted from them
+            for name in set(self.members) - set(self.extracted):
+                path = safe_path(self.extractpath, name)
+                if not path:
+                    continue
+                if os.path.isfile(path):
+                    os.unlink(path)
+                if os.path.isdir(path + NESTED_SUFFIX):
+                    shutil.rmtree(path + NESTED_SUFFIX)
+                if os.path.isfile(ExtractManifest.manifestpath(path + NESTED_SUFFIX)):
+                    os.unlink(ExtractManifest.manifestpath(path + NESTED_SUFFIX))
+            self.members = self.extracted
+        else:
+            self.members.update(self.extracted)
+
+        self.archive = identity
+        self.complete = complete
+        write_json_atomic(self.path, {
+            'archive': self.archive, 'complete': complete, 'members': self.members
+        })
+
+
+def write_member(source, path, mtime, chunksize=1024 * 1024):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as fd:
+        shutil.copyfileobj(source, fd, chunksize)
+    os.utime(path, (mtime, mtime))
+
+
+def register_extractor(kind, func=None, mimetypes=(), extensions=(), signatures=(), stream=None):
+    # func(archivepath, extractpath, manifest) extracts the archive, calling manifest.unchanged()
+    # to skip members and manifest.record() for each member written. Archives that can be read
+    # from start to end pass stream(fileobj, extractpath, manifest) instead, so they can be
+    # extracted while downloading. Signatures are (offset, bytes) found at the start of the file.
+    # pylint: disable=too-many-arguments
+    EXTRACTORS[kind] = func or from_file(stream)
+    if stream:
+        STREAM_EXTRACTORS[kind] = stream
+    for mimetype in mimetypes:
+        MIME_TYPES[mimetype] = kind
+    for extension in extensions:
+        EXTENSIONS[extension] = kind
+    for offset, signature in signatures:
+        SIGNATURES.append((offset, signature, kind))
+
+
+def from_file(stream):
+    def extractor(archivepath, extractpath, manifest):
+        with open(archivepath, 'rb') as fd:
+            stream(fd, extractpath, manifest)
+    return extractor
+
+
+def kind_for_name(name):
+    name = name.lower()
+    matches = [ext for ext in EXTENSIONS if name.endswith(ext)]
+    return EXTENSIONS[max(matches, key=len)] if matches else None
+
+
+def sniff(head):
+    for offset, signature, kind in SIGNATURES:
+        if head[offset:offset + len(signature)] == signature:
+            return kind
+    return None
+
+
+def sniff_file(path):
+    with open(path, 'rb') as fd:
+        return sniff(fd.read(SNIFF_SIZE))
+
+
+def extract_zip(archivepath, extractpath, manifest, patterns=None):
+    with MappedFile(archivepath) as fd, ZipFile(fd) as zf:
+        members = []
+        for info in zf.infolist():
+            if info.is_dir():
+                continue
+            if patterns and not any(fnmatch.fnmatch(info.filename, pat) for pat in patterns):
+                continue
+
+            path = safe_path(extractpath, info.filename)
+            mtime = time.mktime(info.date_time + (0, 0, -1))
+            if path and not manifest.unchanged(info.filename, info.file_size, mtime, info.CRC):
+                members.append((info, path, mtime))
+
+        # Members can be decompressed in parallel, zlib releases the GIL
+        def write(member):
+            info, path, mtime = member
+            with zf.open(info) as source:
+                write_member(source, path, mtime)
+            manifest.record(info.filename, info.file_size, mtime, info.CRC)
+
+        for _ in parallel_map(write, members, EXTRACT_JOBS):
+            pass
+
+
+def extract_tar_members(tf, extractpath, manifest):
+    for member in tf:
+        if member.isdir():
+            continue
+
+        path = safe_path(extractpath, member.name)
+        if not path:
+            continue
+
+        if not member.isfile():
+            # Links and special files, let tarfile check them if it can
+            if hasattr(tarfile, 'data_filter'):
+                try:
+                    tf.extract(member, extractpath, filter='data')
+                except tarfile.FilterError as e:
+                    print("Skipping %s: %s" % (member.name, e))
+            continue
+
+        if manifest.unchanged(member.name, member.size, member.mtime):
+            continue
+
+        write_member(tf.extractfile(member), path, member.mtime)
+        manifest.record(member.name, member.size, member.mtime)
+
+
+def extract_tar(fileobj, extractpath, manifest):
+    # Streaming mode reads the archive once from start to end, for any compression tarfile knows
+    with tarfile.open(fileobj=fileobj, mode='r|*') as tf:
+        extract_tar_members(tf, extractpath, manifest)
+
+
+def extract_tar_zst(fileobj, extractpath, manifest):
+    if not zstandard:
+        raise Exception("Install zstandard to extract zstd compressed archives")
+
+    with zstandard.ZstdDecompressor().stream_reader(fileobj) as reader:
+        extract_tar(reader, extractpath, manifest)
+
+
+def extract_7z(archivepath, extractpath, manifest):
+    # The 7z backends can only extract everything, afterwards the files are recorded
+    if os.path.exists(extractpath):
+        shutil.rmtree(extractpath)
+    os.makedirs(extractpath, exist_ok=True)
+
+    with SevenZFile(archivepath, 'rb') as zf:
+        zf.extractall(extractpath)
+
+    for dirpath, _, filenames in os.walk(extractpath):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            stat = os.stat(path)
+            manifest.record(os.path.relpath(path, extractpath), stat.st_size, stat.st_mtime)
+
+
+register_extractor('zip', extract_zip,
+                   mimetypes=('application/zip', 'application/x-xpinstall',
+                              'application/java-archive'),
+                   extensions=('.zip', '.xpi', '.jar'),
+                   signatures=((0, b'PK\x03\x04'), (0, b'PK\x05\x06')))
+register_extractor('tar', stream=extract_tar,
+                   mimetypes=('application/x-tar', 'application/gzip', 'application/x-gzip',
+                              'application/x-xz', 'application/x-bzip2'),
+                   extensions=('.tar', '.tar.gz', '.tgz', '.tar.xz', '.txz', '.tar.bz2', '.tbz2'),
+                   signatures=((0, b'\x1f\x8b'), (0, b'\xfd7zXZ\x00'), (0, b'BZh'),
+                               (257, b'ustar')))
+register_extractor('tar.zst', stream=extract_tar_zst,
+                   mimetypes=('application/zstd', 'application/x-zstd'),
+                   extensions=('.tar.zst', '.tzst'),
+                   signatures=((0, b'\x28\xb5\x2f\xfd'),))
+register_extractor('7z', extract_7z,
+                   mimetypes=('application/x-7z-compressed',),
+                   extensions=('.7z',),
+                   signatures=((0, b"7z\xbc\xaf'\x1c"),))
+
+
+def extract(kind, archivepath, extractpath, archivehash=None, patterns=None, depth=None):
+    # Returns False if the archive was extracted before and nothing needed to be done. Archives
+    # inside the archive are extracted as well, up to depth levels deep.
+    # pylint: disable=too-many-arguments
+    depth = NESTED_DEPTH if depth is None else depth
+    manifest = ExtractManifest(extractpath)
+    identity = ExtractManifest.identify(archivepath, archivehash)
+
+    changed = patterns or not manifest.same_archive(identity) or \
+        not all(manifest.on_disk(name, entry) for name, entry in manifest.members.items())
+
+    if changed:
+        os.makedirs(extractpath, exist_ok=True)
+        if patterns:
+            EXTRACTORS[kind](archivepath, extractpath, manifest, patterns)
+        else:
+            EXTRACTORS[kind](archivepath, extractpath, manifest)
+        manifest.save(identity, complete=not patterns)
+
+    if not patterns:
+        changed = extract_nested(extractpath, manifest, depth) or changed
+    return bool(changed)
+
+
+def extract_nested(extractpath, manifest, depth):
+    changed = False
+    if depth <= 0:
+        return changed
+
+    for name in manifest.members:
+        kind = kind_for_name(name)
+        if not kind:
+            continue
+
+        path = safe_path(extractpath, name)
+        try:
+            changed = extract(kind, path, path + NESTED_SUFFIX, depth=depth - 1) or changed
+        except Exception as e:  # pylint: disable=broad-except
+            print("Could not extract %s: %s" % (name, e))
+    return changed
+
+
+class StreamPipe:
+    # A file object reading the chunks another thread feeds it, until it is closed
+
+    def __init__(self, maxchunks):
+        self.chunks = queue.Queue(maxchunks)
+        self.current = memoryview(b'')
+        self.eof = False
+
+    def feed(self, data):
+        self.chunks.put(data)
+
+    def close(self):
+        self.chunks.put(None)
+
+    def next_chunk(self):
+        while not self.current and not self.eof:
+            chunk = self.chunks.get()
+            if chunk is None:
+                self.eof = True
+            else:
+                self.current = memoryview(chunk)
+        return self.current
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b''.join(iter(lambda: self.read(MAX_READ), b''))
+
+        chunk = self.next_chunk()
+        data = bytes(chunk[:size])
+        self.current = chunk[size:]
+        return data
+
+    def drain(self):
+        # Discard the rest, so the feeding thread doesn't wait for a reader that has stopped
+        while self.next_chunk():
+            self.current = memoryview(b'')
+
+
+class StreamExtractor:
+    # Gets each chunk of a download, in order. The archive type is sniffed from the first bytes,
+    # archives that can be read as a stream are extracted on a separate thread while they are
+    # downloaded. Other archives, or files that were not downloaded again, are extracted by
+    # finish() once the file is complete.
+
+    def __init__(self, extractpath, depth=None):
+        self.extractpath = extractpath
+        self.depth = NESTED_DEPTH if depth is None else depth
+        self.manifest = ExtractManifest(extractpath)
+        self.head = b''
+        self.kind = None
+        self.sniffed = False
+        self.pipe = None
+        self.thread = None
+        self.error = None
+
+    def feed(self, data):
+        if self.pipe:
+            self.pipe.feed(bytes(data))
+        elif not self.sniffed:
+            self.head += bytes(data)
+            if len(self.head) >= SNIFF_SIZE:
+                self.start()
+
+    def start(self):
+        self.sniffed = True
+        self.kind = sniff(self.head)
+        if self.kind in STREAM_EXTRACTORS:
+            self.pipe = StreamPipe(STREAM_CHUNKS)
+            self.pipe.feed(self.head)
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        self.head = b''
+
+    def run(self):
+        try:
+            os.makedirs(self.extractpath, exist_ok=True)
+            STREAM_EXTRACTORS[self.kind](self.pipe, self.extractpath, self.manifest)
+        except Exception as e:  # pylint: disable=broad-except
+            self.error = e
+        finally:
+            self.pipe.drain()
+
+    def close(self):
+        # The download has ended, wait for the extraction to catch up
+        if not self.sniffed and self.head:
+            self.start()
+        if self.thread:
+            self.pipe.close()
+            self.thread.join()
+
+    def finish(self, kind, archivepath, archivehash=None):
+        # Returns like extract(). Call close() first, kind is used if the file wasn't streamed.
+        if not self.thread:
+            return extract(kind, archivepath, self.extractpath, archivehash, depth=self.depth)
+
+        if self.error:
+            raise self.error
+
+        self.manifest.save(ExtractManifest.identify(archivepath, archivehash))
+        extract_nested(self.extractpath, self.manifest, self.depth)
+        return True
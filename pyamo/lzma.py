@@ -4,30 +4,90 @@
 # Portions Copyright (C) Philipp Kewisch, 2015
 
 import os
+import subprocess
 
 from py7zlib import Archive7z
 
+from .utils import AMO_CONFIG, find_in_path
+
+try:
+    import py7zr
+except ImportError:
+    py7zr = None
+
+# py7zlib decompresses each member into memory, larger members are skipped
+DEFAULT_MAX_MEMBER_SIZE = 512 * 1024 * 1024
+
+SEVENZIP_BINARIES = ('7zz', '7z', '7za')
+
+
+def find_7z():
+    binary = AMO_CONFIG.get('pyamo', 'sevenzip', 'binary', fallback=None)
+    if binary:
+        return os.path.expanduser(binary)
+
+    for name in SEVENZIP_BINARIES:
+        path = find_in_path(name)
+        if path:
+            return path
+    return None
+
 
 class SevenZFile:
     # pylint: disable=too-few-public-methods
+    # Extracts using the 7z binary or py7zr if available, which write members to disk in chunks.
+    # Falls back to py7zlib, which needs to keep each member in memory.
 
     def __init__(self, filepath, mode='rb'):
-        self.fd = open(filepath, mode)
-        self.archive = Archive7z(self.fd)
+        self.filepath = filepath
+        self.mode = mode
+        self.max_member_size = AMO_CONFIG.get('pyamo', 'sevenzip', 'max_member_size',
+                                              fallback=DEFAULT_MAX_MEMBER_SIZE)
 
     def __enter__(self):
         return self
 
     def __exit__(self, vtype, value, traceback):
-        if self.fd:
-            self.fd.close()
+        return False
 
     def extractall(self, path):
-        for name in self.archive.getnames():
-            outfilename = os.path.join(path, name)
-            outdir = os.path.dirname(outfilename)
-            if not os.path.exists(outdir):
-                os.makedirs(outdir)
-            outfile = open(outfilename, 'wb')
-            outfile.write(self.archive.getmember(name).read())
-            outfile.close()
+        binary = find_7z()
+        if binary:
+            # An empty password and no stdin, so encrypted archives fail instead of prompting
+            proc = subprocess.run(
+                [binary, 'x', '-y', '-bd', '-p', '-o' + path, '--', self.filepath],
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                check=False
+            )
+            if proc.returncode != 0:
+                raise Exception("%s failed to extract %s: %s" % (
+                    os.path.basename(binary), self.filepath,
+                    proc.stderr.decode('utf-8', 'replace').strip()
+                ))
+        elif py7zr:
+            with py7zr.SevenZipFile(self.filepath, 'r') as archive:
+                archive.extractall(path)
+        else:
+            self.extractall_py7zlib(path)
+
+    def extractall_py7zlib(self, path):
+        root = os.path.realpath(path)
+        with open(self.filepath, self.mode) as fd:
+            archive = Archive7z(fd)
+            members = archive.getmembers()
+
+            # Fail before extracting anything, the sources would otherwise be incomplete
+            for member in members:
+                if member.size > self.max_member_size:
+                    raise Exception("%s is larger than %d bytes. Install 7z or py7zr to extract it"
+                                    % (member.filename, self.max_member_size))
+
+            for member in members:
+                outfilename = os.path.realpath(os.path.join(path, member.filename))
+                if not outfilename.startswith(root + os.sep):
+                    print("Skipping %s, it is outside of the target directory" % member.filename)
+                    continue
+
+                os.makedirs(os.path.dirname(outfilename), exist_ok=True)
+                with open(outfilename, 'wb') as outfile:
+                    outfile.write(member.read())
@@ -0,0 +1,152 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+# Portions Copyright (C) Philipp Kewisch, 2026
+
+import time
+import random
+import threading
+
+from urllib.parse import urlparse
+from email.utils import parsedate_to_datetime
+
+import requests
+
+from .utils import AMO_CONFIG
+
+IDEMPOTENT_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'))
+RETRY_STATUS = frozenset((429, 502, 503, 504))
+
+DEFAULT_RETRIES = 5
+DEFAULT_BACKOFF = 1.0
+DEFAULT_MAX_BACKOFF = 60.0
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(1, rate))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def pause(self, seconds):
+        # Used when the server tells us to back off, so all threads using this host wait.
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if now < self.paused_until:
+                    delay = self.paused_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    delay = (1 - self.tokens) / self.rate
+
+            time.sleep(delay)
+
+
+class RequestPolicy:
+    def __init__(self, limits=None, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF,
+                 max_backoff=DEFAULT_MAX_BACKOFF):
+        self.buckets = {}
+        for host, limit in (limits or {}).items():
+            if isinstance(limit, dict):
+                self.buckets[host] = TokenBucket(limit['rate'], limit.get('burst'))
+            else:
+                self.buckets[host] = TokenBucket(limit)
+
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    @staticmethod
+    def from_config():
+        # {"pyamo": {"ratelimit": {"addons.mozilla.org": 10}, "retries": {"max": 5}}}
+        return RequestPolicy(
+            AMO_CONFIG.get('pyamo', 'ratelimit', fallback={}),
+            retries=AMO_CONFIG.get('pyamo', 'retries', 'max', fallback=DEFAULT_RETRIES),
+            backoff=AMO_CONFIG.get('pyamo', 'retries', 'backoff', fallback=DEFAULT_BACKOFF),
+            max_backoff=AMO_CONFIG.get('pyamo', 'retries', 'max_backoff',
+                                       fallback=DEFAULT_MAX_BACKOFF)
+        )
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    @staticmethod
+    def retry_after(resp):
+        value = resp.headers.get('retry-after')
+        if not value:
+            return None
+
+        try:
+            return max(0, float(value))
+        except ValueError:
+            pass
+
+        try:
+            return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def can_retry(method, kwargs, status=None):
+        if kwargs.get('files') or hasattr(kwargs.get('data'), 'read'):
+            # The body has been consumed, we can't send it again
+            return False
+
+        # A 429 means the request was not processed, so it is safe to repeat for all methods
+        return method.upper() in IDEMPOTENT_METHODS or status == 429
+
+    def send(self, sendfunc, method, url, **kwargs):
+        bucket = self.buckets.get(urlparse(url).hostname)
+        attempt = 0
+
+        while True:
+            if bucket:
+                bucket.acquire()
+
+            try:
+                resp = sendfunc(method, url, **kwargs)
+            except requests.exceptions.ConnectTimeout:
+                # Usually means the VPN is not connected, retrying won't help
+                raise
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if attempt >= self.retries or not self.can_retry(method, kwargs):
+                    raise
+                delay = self.delay(attempt)
+            else:
+                if resp.status_code not in RETRY_STATUS or attempt >= self.retries or \
+                   not self.can_retry(method, kwargs, resp.status_code):
+                    resp.retries = attempt
+                    return resp
+
+                delay = self.retry_after(resp)
+                if delay is None:
+                    delay = self.delay(attempt)
+                elif bucket and resp.status_code == 429:
+                    bucket.pause(delay)
+                resp.close()
+
+            attempt += 1
+            time.sleep(delay)
+
+
+class PolicySession(requests.Session):
+    # A plain session with the retry and rate limiting policy, for services other than AMO
+
+    def __init__(self, policy=None):
+        super().__init__()
+        self.policy = policy or RequestPolicy.from_config()
+
+    def request(self, method, url, **kwargs):  # pylint: disable=arguments-differ
+        return self.policy.send(super().request, method, url, **kwargs)
@@ -8,25 +8,151 @@ import re
 import cgi
 import shutil
 import traceback
-import tarfile
 
-from zipfile import ZipFile, BadZipfile
+from zipfile import BadZipfile
 from urllib.parse import urlparse, urljoin, unquote
 from mozprofile import FirefoxProfile
 from cmp_version import cmp_version
 
+from dateutil import parser as dateparser
+
 import lxml.html
 import magic
+import requests
 
-from .utils import AMO_BASE, AMO_EDITOR_BASE, AMO_REVIEWERS_API_BASE, csspath
+from .utils import AMO_BASE, AMO_API_BASE, AMO_EDITOR_BASE, AMO_REVIEWERS_API_BASE, AMO_CONFIG, \
+    Selectors, page_count
 from .user import User
-from .lzma import SevenZFile
+from .download import BlobStore, fetch
+from .archive import XPIView
+from .extract import MIME_TYPES, StreamExtractor, extract, kind_for_name, sniff_file
+
+# The number of versions per page when using the API backend, 50 is the maximum AMO allows
+API_PAGE_SIZE = AMO_CONFIG.get('pyamo', 'api_page_size', fallback=50)
+
+# The API file statuses and months in dates, as shown on the review page
+API_FILE_STATUS = {
+    'incomplete': 'Incomplete',
+    'unreviewed': 'Awaiting Review',
+    'nominated': 'Awaiting Review',
+    'public': 'Approved',
+    'disabled': 'Disabled by Mozilla',
+    'deleted': 'Deleted'
+}
+AP_MONTHS = ('Jan.', 'Feb.', 'March', 'April', 'May', 'June', 'July', 'Aug.', 'Sept.', 'Oct.',
+             'Nov.', 'Dec.')
+
+SELECTORS = Selectors(
+    addonname='h2.addon span:first-of-type',
+    token='form input[name="csrfmiddlewaretoken"]',
+    enabledversions='#id_versions > option',
+    addon='#addon',
+    slug=".file-info > .light > a:not([title])",
+    slug_fallback="#actions-addon > li > a[href$='/edit']",
+    actions='[name="action"]',
+    downloads=(None, '//strong[@class="downloads"]'),
+    first_page=".review-files-paginate > .pagination > li > strong:first-of-type, " +
+               "#review-files-paginate > .pagination > li > strong:first-of-type",
+    pagelinks=".review-files-paginate > .pagination a[href*='page='], " +
+              "#review-files-paginate > .pagination a[href*='page=']",
+    versionoptions='#id_versions option',
+    heads='.review-files > .listing-header, #review-files > .listing-header',
+    developers='#scroll_sidebar ul:not([id]) a[href*="/user/"]',
+
+    head_lights="th .light",
+    fileinfo='.file-info',
+    codemanager="a[href^='https://code.addons.mozilla.org']",
+    sourcelink='.files > div > a[href]',
+    appicons='.files > ul > li > .app-icon',
+
+    install='.reviewers-install',
+    filestatus='.light > div',
+    permissions=".file-permissions strong"
+)
+
+
+class VersionList:
+    # Versions of a review, oldest first like on the review page. The review pages are loaded
+    # newest first, so pages are added to the front. Internally they are kept newest first so
+    # adding a page doesn't copy the versions loaded so far.
+
+    def __init__(self):
+        self.newest_first = []
+        self.pages = []
+        self.versions = {}
+        self.ids = {}
+        self.fileids = {}
+        self.positions = {}
+        self.latest_wx = None
+        self.previous = None
+
+    def __len__(self):
+        return len(self.newest_first)
+
+    def __iter__(self):
+        return reversed(self.newest_first)
+
+    def __reversed__(self):
+        return iter(self.newest_first)
+
+    def __bool__(self):
+        return len(self.newest_first) > 0
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[idx] for idx in range(*index.indices(len(self)))]
+
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("version index out of range")
+        return self.newest_first[len(self) - index - 1]
+
+    def add_page(self, versions):
+        # Adds the versions of the next (older) page, versions are ordered oldest first
+        self.pages.append(versions)
+        for version in reversed(versions):
+            position = len(self.newest_first)
+            self.newest_first.append(version)
+            self.positions[version] = position
+
+            # The newest version wins if a version string is used more than once
+            self.versions.setdefault(version.version, version)
+            if version.id:
+                self.ids.setdefault(version.id, version)
+            for vfile in version.files:
+                self.fileids.setdefault(vfile.fileid, version)
+
+            if not self.latest_wx and any(vfile.permissions for vfile in version.files):
+                self.latest_wx = version
+            if not self.previous and position > 0 and version.confirmed:
+                self.previous = version
+
+    @property
+    def latest(self):
+        return self.newest_first[0] if self.newest_first else None
+
+    @property
+    def last_page(self):
+        return self.pages[-1] if self.pages else []
+
+    def by_version(self, version):
+        return self.versions.get(version)
+
+    def by_id(self, versionid):
+        return self.ids.get(versionid)
+
+    def by_fileid(self, fileid):
+        return self.fileids.get(fileid)
+
+    def sort(self, versions):
+        return sorted(versions, key=lambda version: -self.positions[version])
 
 
 class Review:
-    # pylint: disable=too-few-public-methods,too-many-instance-attributes
+    # pylint: disable=too-few-public-methods,too-many-instance-attributes,too-many-public-methods
 
-    def __init__(self, parent, id_or_url, unlisted=False):
+    def __init__(self, parent, id_or_url, unlisted=False, backend='html'):
         id_or_url = str(id_or_url)
         if id_or_url.startswith(AMO_BASE) or id_or_url.startswith(AMO_EDITOR_BASE):
             addonid = id_or_url.split("/")[-1]
@@ -40,13 +166,15 @@ class Review:
         self.addonname = None
         self.token = None
         self.actions = []
-        self.versions = []
+        self.versions = VersionList()
         self.unlisted = unlisted
         if unlisted:
             self.url = '%s/review-unlisted/%s' % (AMO_EDITOR_BASE, addonid)
         else:
             self.url = '%s/review-listed/%s' % (AMO_EDITOR_BASE, addonid)
         self.page = 0
+        self.pagecount = None
+        self.backend = backend
 
         self.versionmap = {}
         self.adu = 0
@@ -57,26 +185,18 @@ class Review:
         self.developers = []
 
     def find_latest_version(self):
-        if len(self.versions) > 0:
-            return self.versions[-1]
-        else:
-            return None
+        return self.versions.latest
 
     def find_latest_version_wx(self):
-        for version in reversed(self.versions):
-            if any(vfile.permissions for vfile in version.files):
-                return version
-        return None
+        return self.versions.latest_wx
 
     def find_previous_version(self):
-        for version in reversed(self.versions[:-1]):
-            if version.confirmed:
-                return version
-        return None
+        return self.versions.previous
 
     def get(self):
-        self.versions = []
+        self.versions = VersionList()
         self.page = 0
+        self.pagecount = None
         self.get_version_page(1)
 
     def get_next_page(self):
@@ -102,27 +222,109 @@ class Review:
 
         return req
 
+    @property
+    def api_headers(self):
+        # Raises KeyError if not logged in, the api backend then falls back to the review page
+        return {'Authorization': 'Session ' + self.session.cookies['sessionid']}
+
     def get_version_page(self, page=1):
+        if self.backend == 'api':
+            try:
+                if page == 1:
+                    self.get_api_addon()
+                return self.parse_page(self.fetch_page(page), page)
+            except (requests.exceptions.HTTPError, KeyError, ValueError):
+                if page > 1:
+                    raise
+                # Not all add-ons can be viewed through the API, use the review page instead
+                self.backend = 'html'
+
+        return self.parse_page(self.fetch_page(page), page)
+
+    def fetch_page(self, page):
+        # Only downloads and parses the page, this part can run on multiple threads. The pages
+        # must then be passed to parse_page in order.
+        if self.backend == 'api':
+            url = '%s/addons/addon/%s/versions/' % (AMO_API_BASE, self.addonid)
+            params = {
+                'filter': 'all_with_unlisted' if self.unlisted else 'all_without_unlisted',
+                'page_size': API_PAGE_SIZE,
+                'page': page,
+                'lang': 'en-US'
+            }
+            try:
+                return self.session.get(url, params=params, headers=self.api_headers).json()
+            except requests.exceptions.HTTPError as e:
+                if page > 1 and e.response.status_code == 404:
+                    return None
+                raise
+
         req = self.session.get(self.url + "?page=%d" % page, stream=True, allow_redirects=False)
         req = self.check_redirects(req)
 
         req.raw.decode_content = True
-        doc = lxml.html.parse(req.raw).getroot()
+        return lxml.html.parse(req.raw).getroot()
+
+    def parse_page(self, data, page):
+        if self.backend == 'api':
+            return self.parse_api_page(data, page)
+        else:
+            return self.parse_html_page(data, page)
+
+    def get_api_addon(self):
+        url = '%s/addons/addon/%s/' % (AMO_API_BASE, self.addonid)
+        data = self.session.get(url, params={'lang': 'en-US'}, headers=self.api_headers).json()
+
+        self.addonname = data['name']
+        self.addonid = str(data['id'])
+        self.slug = data['slug']
+        self.adu = data.get('average_daily_users', 0)
+        self.downloads = data.get('weekly_downloads', 0)
+
+        if self.unlisted:
+            self.url = '%s/review-unlisted/%s' % (AMO_EDITOR_BASE, self.slug)
+        else:
+            self.url = '%s/review-listed/%s' % (AMO_EDITOR_BASE, self.slug)
+
+        self.developers = [User.getcache(self.parent, author['id'])
+                           for author in data.get('authors', [])]
+
+    def parse_api_page(self, data, page):
+        if data is None:
+            # We've gone over the last page
+            return False
+
+        self.pagecount = -(-data['count'] // API_PAGE_SIZE) or 1
+
+        channel = 'unlisted' if self.unlisted else 'listed'
+        versions = [
+            AddonReviewVersion.from_api(self, version) for version in reversed(data['results'])
+            if version.get('channel', channel) == channel
+        ]
+        for version in versions:
+            self.versionmap[version.version] = version.id
+            if not all(vfile.status == API_FILE_STATUS['disabled'] for vfile in version.files):
+                self.enabledversions.append(version.id)
 
-        namenodes = doc.xpath(csspath('h2.addon span:first-of-type'))
+        self.versions.add_page(versions)
+        self.page = page
+        return True
+
+    def parse_html_page(self, doc, page):
+        namenodes = SELECTORS.addonname(doc)
         self.addonname = namenodes[0].text.strip().replace("Review ", "", 1)
 
-        self.token = doc.xpath(csspath('form input[name="csrfmiddlewaretoken"]'))[0].attrib['value']
+        self.token = SELECTORS.token(doc)[0].attrib['value']
         self.enabledversions = [
-          x.attrib['value'] for x in doc.xpath(csspath('#id_versions > option'))
+          x.attrib['value'] for x in SELECTORS.enabledversions(doc)
         ]
 
-        self.addonid = doc.xpath(csspath('#addon'))[0].attrib['data-id']
+        self.addonid = SELECTORS.addon(doc)[0].attrib['data-id']
         try:
-            slugnodes = doc.xpath(csspath(".file-info > .light > a:not([title])"))
+            slugnodes = SELECTORS.slug(doc)
             self.slug = unquote(slugnodes[0].attrib['href'].split("/")[-4])
         except IndexError:
-            slugnodes = doc.xpath(csspath("#actions-addon > li > a[href$='/edit']"))
+            slugnodes = SELECTORS.slug_fallback(doc)
             self.slug = unquote(slugnodes[0].attrib['href'].split("/")[-4])
 
         if self.unlisted:
@@ -131,56 +333,91 @@ class Review:
             self.url = '%s/review-listed/%s' % (AMO_EDITOR_BASE, self.slug)
 
         self.actions = [
-            i.attrib['value'] for i in doc.xpath(csspath('[name="action"]'))
+            i.attrib['value'] for i in SELECTORS.actions(doc)
         ]
 
-        downloadnodes = doc.xpath('//strong[@class="downloads"]')
+        downloadnodes = SELECTORS.downloads(doc)
         self.downloads = 0
         if len(downloadnodes) > 0:
             self.downloads = int(downloadnodes[0].text.replace(",", ""))
 
         self.adu = int(downloadnodes[1].text.replace(",", "")) if len(downloadnodes) > 1 else 0
 
-        first_page_path = ".review-files-paginate > .pagination > li > strong:first-of-type, " + \
-            "#review-files-paginate > .pagination > li > strong:first-of-type"
-        first_page_node = doc.xpath(csspath(first_page_path))
+        first_page_node = SELECTORS.first_page(doc)
         is_first_page = first_page_node[0].text == "1" if len(first_page_node) > 0 else True
 
         if page > 1 and is_first_page:
             # We've gone over the last page, need to bail early
             return False
 
+        pagecount = page_count(SELECTORS.pagelinks(doc))
+        self.pagecount = max(pagecount, page) if pagecount else None
+
         self.versionmap = {}
-        options = doc.xpath(csspath('#id_versions option'))
+        options = SELECTORS.versionoptions(doc)
         for option in options:
             self.versionmap[option.text] = option.attrib['value']
 
-        heads = doc.xpath(
-          csspath('.review-files > .listing-header, #review-files > .listing-header')
-        )
+        heads = SELECTORS.heads(doc)
 
         versions = []
         for head in heads:
             versions.append(AddonReviewVersion(self, head, head.getnext()))
 
-        self.versions = versions + self.versions
+        self.versions.add_page(versions)
 
-        devnodes = doc.xpath(
-          csspath('#scroll_sidebar ul:not([id]) a[href*="/user/"]')
-        )
+        devnodes = SELECTORS.developers(doc)
 
         for dev in devnodes:
-            self.developers.append(User.getcache(self.parent, dev.attrib['href'].split("/")[-2]))
+            # The sidebar is repeated on every page
+            user = User.getcache(self.parent, dev.attrib['href'].split("/")[-2])
+            if user not in self.developers:
+                self.developers.append(user)
 
         self.page = page
         return True
 
     def get_all_versions(self):
-        incomplete = True
+        incomplete = self.page > 0 or self.get_next_page()
         while incomplete:
-            incomplete = self.get_next_page()
+            if self.pagecount is None:
+                # No pagination links, go page by page until we are past the last page
+                incomplete = self.get_next_page()
+                continue
+
+            # Fetch the remaining pages at once, later pages may link to more pages
+            pages = range(self.page + 1, self.pagecount + 1)
+            incomplete = len(pages) > 0
+            for page, data in zip(pages, self.parent.page_map(self.fetch_page, pages)):
+                incomplete = self.parse_page(data, page)
+                if not incomplete:
+                    break
+
         return self.versions
 
+    def add_file_hashes(self, hashes):
+        # Hashes from the admin page, e.g. AdminInfo.file_hashes(), to share identical files
+        for fileid, filehash in hashes.items():
+            version = self.versions.by_fileid(str(fileid))
+            for vfile in version.files if version else []:
+                if vfile.fileid == str(fileid):
+                    vfile.hash = filehash
+
+    def load_file_hashes(self, versions):
+        # The admin page lists the hash of each file, which is used to verify the downloads and to
+        # share identical files in the blob store. Returns False if the page is not available,
+        # e.g. without admin permissions or the VPN.
+        if all(vfile.hash for version in versions for vfile in version.files):
+            return True
+
+        try:
+            admininfo = self.parent.get_admin_info(self.addonid)
+        except Exception:  # pylint: disable=broad-except
+            return False
+
+        self.add_file_hashes(admininfo.file_hashes())
+        return True
+
     def get_versions_until(self, func, default=None):
         res = default
         while True:
@@ -223,8 +460,8 @@ class Review:
 
     def flags(self, flags=None):
         url = AMO_REVIEWERS_API_BASE + '/addon/%s/flags/' % self.addonid
-        headers = {'Authorization': 'Session ' + self.session.cookies.get('sessionid')}
-        req = self.session.patch(url, json=flags or {}, headers=headers, allow_redirects=False)
+        req = self.session.patch(url, json=flags or {}, headers=self.api_headers,
+                                 allow_redirects=False)
         print(req.json())
         if not req.status_code == 200:
             raise Exception("Request error %d" % req.status_code)
@@ -232,8 +469,7 @@ class Review:
 
     def admin_disable(self):
         url = AMO_REVIEWERS_API_BASE + '/addon/%s/disable/' % self.addonid
-        headers = {'Authorization': 'Session ' + self.session.cookies.get('sessionid')}
-        req = self.session.post(url, headers=headers, allow_redirects=False)
+        req = self.session.post(url, headers=self.api_headers, allow_redirects=False)
         return req.status_code == 202
 
     def remove_extra_delay(self):
@@ -253,15 +489,14 @@ class Review:
             "un" if not subscribe else "",
             "un" if self.unlisted else ""
         )
-        headers = {'Authorization': 'Session ' + self.session.cookies.get('sessionid')}
-        req = self.session.post(url, headers=headers, allow_redirects=False)
+        req = self.session.post(url, headers=self.api_headers, allow_redirects=False)
         return req.status_code == 202
 
 
 class AddonReviewVersion:
     # pylint: disable=too-many-instance-attributes
 
-    def __init__(self, parent, head, body):
+    def __init__(self, parent, head=None, body=None):
         self.parent = parent
         self.session = parent.session
 
@@ -269,19 +504,46 @@ class AddonReviewVersion:
         self.sources = None
         self.sourcepath = None
         self.sourcefilename = None
+        self.sourcehash = None
         self.version = None
+        self.date = None
+        self.confirmed = False
         self.files = []
         self.apps = []
 
-        self._init_head(head)
-        self._init_body(body)
+        if head is not None:
+            self._init_head(head)
+            self._init_body(body)
+
+    @staticmethod
+    def from_api(parent, data):
+        version = AddonReviewVersion(parent)
+        version.id = str(data['id'])
+        version.version = data['version']
+
+        files = data['files'] if 'files' in data else [data['file']]
+        version.files = [AddonVersionFile.from_api(version, filedata) for filedata in files]
+        version.apps = list(data.get('compatibility', {}).keys())
+        version.sources = data.get('source') or None
+
+        # The API doesn't distinguish confirmed auto-approvals, use the approval instead
+        version.confirmed = any(vfile.status == API_FILE_STATUS['public']
+                                for vfile in version.files)
+
+        created = files[0].get('created') if files else None
+        if created:
+            # Same as the review page, e.g. "Sept. 5, 2020"
+            date = dateparser.parse(created)
+            version.date = '%s %d, %d' % (AP_MONTHS[date.month - 1], date.day, date.year)
+
+        return version
 
     def _init_head(self, head):
         args = next(head.iterchildren()).text.strip().split(" ")
         _, self.version, _, month, day, year = [_f for _f in args if _f]
         self.date = '%s %s %s' % (month, day, year)
 
-        lights = head.xpath(csspath("th .light"))
+        lights = SELECTORS.head_lights(head)
         self.confirmed = len(lights) > 1 and lights[1].text == "(Confirmed)"
 
         # This will work for non-deleted files, and is better for multiple files per version
@@ -290,20 +552,20 @@ class AddonReviewVersion:
             self.id = self.parent.versionmap[self.version]
 
     def _init_body(self, body):
-        fileinfo = body.xpath(csspath('.file-info'))
+        fileinfo = SELECTORS.fileinfo(body)
         for info in fileinfo:
             self.files.append(AddonVersionFile(self, info))
 
         # This is the fallback to determine the id for deleted add-ons
-        codemgr = fileinfo[0].xpath(csspath("a[href^='https://code.addons.mozilla.org']"))
+        codemgr = SELECTORS.codemanager(fileinfo[0])
         if codemgr and not self.id:
             self.id = codemgr[0].attrib['href'].split("/")[-2]
 
-        sourcelink = body.xpath(csspath('.files > div > a[href]'))
+        sourcelink = SELECTORS.sourcelink(body)
         if len(sourcelink) > 0:
             self.sources = urljoin(AMO_EDITOR_BASE, sourcelink[0].attrib['href'])
 
-        appnodes = body.xpath(csspath('.files > ul > li > .app-icon'))
+        appnodes = SELECTORS.appicons(body)
         if len(appnodes) > 0:
             appre = re.compile(r'ed-sprite-(\w+)')
             for node in appnodes:
@@ -311,58 +573,48 @@ class AddonReviewVersion:
                 if matches:
                     self.apps.append(matches.group(1))
 
-    def savesources(self, targetpath, chunksize=16384):
+    def savesources(self, targetpath, chunksize=16384, consumer=None):
         if self.sources:
-            req = self.session.get(self.sources, stream=True)
-
-            _, params = cgi.parse_header(req.headers['content-disposition'])
+            def sourcename(headers):
+                _, params = cgi.parse_header(headers['content-disposition'])
 
-            self.sourcefilename = params['filename']
-            base, ext = os.path.splitext(params['filename'])
-            if ext == ".gz":
-                _, tarext = os.path.splitext(base)
-                if tarext == ".tar":
-                    ext = ".tar.gz"
+                self.sourcefilename = params['filename']
+                base, ext = os.path.splitext(params['filename'])
+                if ext in (".gz", ".xz", ".bz2", ".zst"):
+                    _, tarext = os.path.splitext(base)
+                    if tarext == ".tar":
+                        ext = ".tar" + ext
 
-            self.sourcepath = os.path.join(targetpath, self.version, "sources" + ext)
-            sourcedir = os.path.dirname(self.sourcepath)
-            if not os.path.exists(sourcedir):
-                os.mkdir(sourcedir)
+                return os.path.join(targetpath, self.version, "sources" + ext)
 
-            with open(self.sourcepath, 'wb') as fd:
-                for chunk in req.iter_content(chunksize):
-                    fd.write(chunk)
+            # Sources can be replaced by the developer, so they are checked with the server again
+            self.sourcepath, self.sourcehash = fetch(
+                self.session, self.sources, os.path.join(targetpath, self.version), sourcename,
+                chunksize, key=BlobStore.key(url=self.sources), consumer=consumer
+            )
 
     def extractsources(self, targetpath):
-        if not self.sourcepath:
-            self.savesources(targetpath)
-
         extractpath = os.path.join(targetpath, self.version, "src")
 
-        if os.path.exists(extractpath):
-            shutil.rmtree(extractpath)
-
+        # If the sources still need to be downloaded, tar archives are extracted at the same time
+        streamer = StreamExtractor(extractpath)
         try:
-            os.makedirs(extractpath)
-        except OSError:
-            pass
-
-        mime = magic.from_file(self.sourcepath, mime=True)
+            if not self.sourcepath:
+                self.savesources(targetpath, consumer=streamer)
+        finally:
+            streamer.close()
+
+        kind = streamer.kind or sniff_file(self.sourcepath)
+        if not kind:
+            mime = magic.from_file(self.sourcepath, mime=True)
+            kind = MIME_TYPES.get(mime) or kind_for_name(self.sourcefilename or self.sourcepath)
+            if not kind:
+                print("Don't know how to handle %s, skipping extraction" % mime)
+                return
 
         try:
-            if mime == "application/x-7z-compressed":
-                with SevenZFile(self.sourcepath, 'r') as zf:
-                    zf.extractall(extractpath)
-            elif mime == "application/zip":
-                with ZipFile(self.sourcepath, 'r') as zf:
-                    zf.extractall(extractpath)
-            elif mime in ('application/x-gzip', 'application/gzip'):
-                with tarfile.open(self.sourcepath, 'r:gz') as zf:
-                    zf.extractall(extractpath)
-            else:
-                print("Don't know how to handle %s, skipping extraction" % mime)
+            streamer.finish(kind, self.sourcepath, self.sourcehash)
         except Exception:  # pylint: disable=broad-except
-            os.rmdir(extractpath)
             traceback.print_exc()
             print("Could not extract sources due to above exception, skipping extraction")
 
@@ -389,11 +641,39 @@ class AddonVersionFile:
         'Android': 'android'
     }
 
-    def __init__(self, parent, fileinfo):
+    def __init__(self, parent, fileinfo=None):
         self.parent = parent
         self.session = parent.session
 
-        infourl = fileinfo.xpath(csspath('.reviewers-install'))
+        self.url = None
+        self.platforms = ["all"]
+        self.status = None
+        self.permissions = None
+        self.filename = None
+        self.fileid = None
+        self.hash = None
+        self.sha256 = None
+        self.savedpath = None
+        self.profile = None
+
+        if fileinfo is not None:
+            self._init_html(fileinfo)
+
+    @staticmethod
+    def from_api(parent, data):
+        vfile = AddonVersionFile(parent)
+        vfile.url = data['url']
+        vfile.fileid = str(data['id'])
+        vfile.filename = urlparse(vfile.url).path.split('/')[-1]
+        vfile.status = API_FILE_STATUS.get(data.get('status'), data.get('status'))
+        vfile.hash = data.get('hash')
+        vfile.permissions = ", ".join(data.get('permissions', [])) or None
+        if data.get('platform', 'all') != 'all':
+            vfile.platforms = [data['platform']]
+        return vfile
+
+    def _init_html(self, fileinfo):
+        infourl = SELECTORS.install(fileinfo)
         self.url = infourl[0].attrib['href']
         self.platforms = [
             self.OS_LABEL_TO_SHORTNAME[platform]
@@ -404,18 +684,16 @@ class AddonVersionFile:
             # This is close enough to "all"
             self.platforms = ["all"]
 
-        statusdiv = fileinfo.xpath(csspath('.light > div'))
+        statusdiv = SELECTORS.filestatus(fileinfo)
         self.status = statusdiv[0].text.strip()
 
-        permnode = fileinfo.xpath(csspath(".file-permissions strong"))
+        permnode = SELECTORS.permissions(fileinfo)
         self.permissions = permnode[0].tail.strip() if len(permnode) > 0 else None
 
         urlpath = urlparse(self.url).path
         urlpathparts = urlpath.split('/')
         self.filename = urlpathparts[-1]
         self.fileid = urlpathparts[-3]
-        self.savedpath = None
-        self.profile = None
 
     def get(self):
         if self.savedpath:
@@ -427,7 +705,15 @@ class AddonVersionFile:
     def _platformsuffix(self):
         return "-" + "-".join(self.platforms) if len(self.parent.files) > 1 else ""
 
-    def extract(self, targetpath):
+    def view(self, targetpath=None):
+        # Reads files from the xpi on demand, without extracting it
+        if not self.savedpath:
+            self.save(targetpath)
+
+        return XPIView(self.savedpath)
+
+    def extract(self, targetpath, members=None):
+        # Extracts the xpi, or only the members matching one of the patterns in members
         if not self.savedpath:
             self.save(targetpath)
 
@@ -436,37 +722,33 @@ class AddonVersionFile:
 
         xpidir = "xpi" + self._platformsuffix
         extractpath = os.path.join(targetpath, self.parent.version, xpidir)
-        try:
-            os.makedirs(os.path.dirname(extractpath))
-        except OSError:
-            pass
+        os.makedirs(os.path.dirname(extractpath), exist_ok=True)
 
         try:
-            with ZipFile(self.savedpath, 'r') as zf:
-                zf.extractall(extractpath)
-        except BadZipfile:
+            extract('zip', self.savedpath, extractpath, self.sha256, members, depth=0)
+        except (BadZipfile, ValueError):
             print("Could not extract xpi, skipping")
 
     def save(self, targetpath, chunksize=16384):
-        response = self.session.get(self.url, stream=True)
-
-        if response.headers['content-type'] == "application/x-xpinstall":
-            xpifile = "addon%s.xpi" % (self._platformsuffix)
-        elif response.headers['content-type'].startswith("text/xml"):
-            xpifile = "addon.xml"
-        else:
-            raise Exception("Unknown content type " + response.headers['content-type'])
+        def xpiname(headers):
+            if headers['content-type'] == "application/x-xpinstall":
+                xpifile = "addon%s.xpi" % (self._platformsuffix)
+            elif headers['content-type'].startswith("text/xml"):
+                xpifile = "addon.xml"
+            else:
+                raise Exception("Unknown content type " + headers['content-type'])
 
-        self.savedpath = os.path.join(targetpath, self.parent.version, xpifile)
+            return os.path.join(targetpath, self.parent.version, xpifile)
 
-        try:
-            os.makedirs(os.path.dirname(self.savedpath))
-        except OSError:
-            pass
+        # The contents of a file id never change, no need to ask the server again
+        self.savedpath, self.sha256 = fetch(
+            self.session, self.url, os.path.join(targetpath, self.parent.version), xpiname,
+            chunksize, key=self.blobkey, revalidate=False, expected_hash=self.hash
+        )
 
-        with open(self.savedpath, 'wb') as fd:
-            for chunk in response.iter_content(chunksize):
-                fd.write(chunk)
+    @property
+    def blobkey(self):
+        return BlobStore.key(self.fileid, self.hash)
 
     def createprofile(self, targetpath, delete=False):
         if not self.savedpath:
@@ -19,21 +19,57 @@ from .admin import AdminInfo, AdminRedashInfo
 from .queue import QueueEntry
 from .logs import LogEntry
 from .review import Review
-from .session import AmoSession
+from .session import AmoSession, DEFAULT_POOL_SIZE
 from .validation import ValidationReport
 from .utils import AMO_BASE, AMO_CONFIG, AMO_EDITOR_BASE, AMO_DEVELOPER_BASE, \
-    AMO_TIMEZONE, VALIDATION_WAIT, UPLOAD_PLATFORM, csspath
+    AMO_TIMEZONE, VALIDATION_WAIT, UPLOAD_PLATFORM, Selectors, HTMLStream, parallel_map, \
+    has_class, parent_matches
+
+PAGE_JOBS = AMO_CONFIG.get('pyamo', 'page_jobs', fallback=4)
+
+SELECTORS = Selectors(
+    queuenext='.data-grid-top > .pagination > li > a[rel="next"]',
+    lognext='.pagination > li > a[rel="next"]',
+    token='form input[name="csrfmiddlewaretoken"]',
+    version_exists=(".item_wrapper a", "[contains(text(), concat('Version ', $version))]")
+)
 
 
 class AddonsService:
-    def __init__(self, login_prompter=None):
+    def __init__(self, login_prompter=None, jobs=1):
         self.session = AmoSession(self, login_prompter)
+        self.jobs = 1
+        self.set_jobs(jobs)
+
+    def set_jobs(self, jobs):
+        self.jobs = max(1, jobs)
+        self.session.configure_pools(max(DEFAULT_POOL_SIZE, self.jobs))
+
+    def parallel_map(self, func, items):
+        return parallel_map(func, items, self.jobs)
+
+    def page_map(self, func, pages):
+        # Used for the pages of a single add-on and similar small lookups, which are fetched in
+        # parallel even without --jobs
+        return parallel_map(func, pages, max(self.jobs, PAGE_JOBS))
+
+    def expand_users(self, users, refresh=False):
+        unique = {user.userid: user for user in users}.values()
+        if refresh:
+            for user in unique:
+                user.invalidate()
+
+        unique = [user for user in unique if not user.email]
+        for _ in self.page_map(lambda user: user.get(), unique):
+            pass
 
     def persist(self):
         self.session.persist()
 
-    def get_review(self, id_or_url, unlisted=False):
-        review = Review(self, id_or_url, unlisted)
+    def get_review(self, id_or_url, unlisted=False, backend=None):
+        # The api backend is faster, but the review actions and token are only on the html page
+        backend = backend or AMO_CONFIG.get('pyamo', 'review_backend', fallback='html')
+        review = Review(self, id_or_url, unlisted, backend)
         review.get()
         return review
 
@@ -54,24 +90,30 @@ class AddonsService:
         redash = AdminRedashInfo(api_key)
         return redash.get_user_addons(user)
 
-    def _unpaginate(self, url, func, params=None, limit=sys.maxsize):
+    def _unpaginate(self, url, match, func, nextselector, params=None, limit=sys.maxsize):
+        # pylint: disable=too-many-arguments
         things = []
-        lastlen = -1
 
         while url and len(things) < limit:
             req = self.session.get(url, stream=True, params=params)
-            req.raw.decode_content = True
-            doc = lxml.html.parse(req.raw).getroot()
             lastlen = len(things)
-            nexturl = func(things, doc)
-            thislen = len(things)
-
-            if lastlen == thislen:
+            nexturl = None
+
+            # Rows are handled as they arrive. Once the limit is reached the rest of the page
+            # and the following pages don't need to be downloaded.
+            with HTMLStream(req, tag='tr') as stream:
+                for row in stream.iterfind(match):
+                    func(things, row)
+                    row.clear()
+                    if len(things) >= limit:
+                        break
+                else:
+                    nextlink = nextselector(stream.finish())
+                    nexturl = nextlink[0].attrib['href'] if len(nextlink) > 0 else None
+
+            if lastlen == len(things):
                 break
 
-            if thislen > limit:
-                things = things[:limit]
-
             # Get the next url and make sure to unset parameters, since they
             # will be provided in the next url anyway.
             url = urljoin(AMO_EDITOR_BASE, nexturl) if nexturl else None
@@ -85,16 +127,15 @@ class AddonsService:
         else:
             name = name_or_url
 
-        def page(queue, doc):
-            queuerows = doc.xpath(csspath('#addon-queue > tbody > .addon-row'))
-            for row in queuerows:
-                queue.append(QueueEntry(self.session, row))
+        def isrow(elem):
+            return has_class(elem, 'addon-row') and \
+                parent_matches(elem, ('tbody', None), (None, 'addon-queue'))
 
-            nextlink = doc.xpath(csspath('.data-grid-top > .pagination > li > a[rel="next"]'))
-            return nextlink[0].attrib['href'] if len(nextlink) > 0 else None
+        def row(queue, elem):
+            queue.append(QueueEntry(self.session, elem))
 
         url = '%s/%s' % (AMO_EDITOR_BASE, name)
-        return self._unpaginate(url, page)
+        return self._unpaginate(url, isrow, row, SELECTORS.queuenext)
 
     def get_logs(self, loglist, start=None, end=None, query=None, limit=sys.maxsize):
         # pylint: disable=too-many-arguments
@@ -119,30 +160,33 @@ class AddonsService:
                 dtend += timedelta(days=1)
             payload['end'] = dtend.astimezone(AMO_TIMEZONE).strftime('%Y-%m-%d')
 
-        def page(logs, doc):
-            logrows = doc.xpath(csspath('#log-listing > tbody > tr[data-addonid]'))
-            for row in logrows:
-                entry = LogEntry(self.session, row)
-                if (not dtstart or entry.date >= dtstart) and \
-                   (not dtend or entry.date <= dtend):
-                    logs.append(entry)
+        def isrow(elem):
+            return 'data-addonid' in elem.attrib and \
+                parent_matches(elem, ('tbody', None), (None, 'log-listing'))
 
-            nextlink = doc.xpath(csspath('.pagination > li > a[rel="next"]'))
-            return nextlink[0].attrib['href'] if len(nextlink) > 0 else None
+        def row(logs, elem):
+            entry = LogEntry(self.session, elem)
+            if (not dtstart or entry.date >= dtstart) and \
+               (not dtend or entry.date <= dtend):
+                logs.append(entry)
 
         url = '%s/%s' % (AMO_EDITOR_BASE, loglist)
-        return self._unpaginate(url, page, params=payload, limit=limit)
+        return self._unpaginate(url, isrow, row, SELECTORS.lognext, params=payload, limit=limit)
 
     def upload(self, addonid, xpi, platform='all'):
         if platform not in UPLOAD_PLATFORM:
             raise Exception("Unknown platform %s" % platform)
 
+        uploadurl = self.start_upload(addonid, xpi)
+        return self.wait_for_validation(addonid, uploadurl, platform)
+
+    def start_upload(self, addonid, xpi):
         uploadurl = None
         url = '%s/addon/%s/versions' % (AMO_DEVELOPER_BASE, addonid)
         req = self.session.get(url, stream=True)
-        req.raw.decode_content = True
-        doc = lxml.html.parse(req.raw).getroot()
-        token = doc.xpath(csspath('form input[name="csrfmiddlewaretoken"]'))[0].attrib['value']
+        with HTMLStream(req, tag='input') as stream:
+            token = stream.find(lambda elem: elem.get('name') == 'csrfmiddlewaretoken')
+            token = token.attrib['value']
 
         with open(xpi, 'rb') as xpifd:
             payload = {
@@ -157,7 +201,7 @@ class AddonsService:
                 raise Exception('Could not upload %s' % xpi)
             uploadurl = req.headers['location']
 
-        return self.wait_for_validation(addonid, uploadurl, platform)
+        return uploadurl
 
     def wait_for_validation(self, addonid, uploadurl, platform='all', interval=VALIDATION_WAIT):
         if platform not in UPLOAD_PLATFORM:
@@ -184,10 +228,9 @@ class AddonsService:
             req = self.session.get(url, stream=True)
             req.raw.decode_content = True
             doc = lxml.html.parse(req.raw).getroot()
-            token = doc.xpath(csspath('form input[name="csrfmiddlewaretoken"]'))[0].attrib['value']
+            token = SELECTORS.token(doc)[0].attrib['value']
 
-            ver_exists = doc.xpath(csspath(".item_wrapper a") +
-                                   "[contains(text(), 'Version %s')]" % report.version)
+            ver_exists = SELECTORS.version_exists(doc, version=report.version)
             if len(ver_exists) > 0:
                 final_version_url = urljoin(AMO_DEVELOPER_BASE, ver_exists[0].attrib['href'])
                 add_version_url = final_version_url + "/submit-file/"
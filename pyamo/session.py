@@ -5,17 +5,107 @@
 
 import os
 import json
+import hashlib
 
 import urllib.parse
+import urllib.request
 import sqlite3
-import http
-import shutil
+import http.cookiejar
 import webbrowser
-import tempfile
+import threading
+import weakref
+
+from contextlib import nullcontext
 
 import requests
 
-from .utils import AMO_API_BASE, AMO_API_AUTH, AMO_ADMIN_BASE, FXASession, fxprofile
+from .utils import AMO_API_BASE, AMO_API_AUTH, AMO_ADMIN_BASE, AMO_HOST, AMO_INTERNAL_HOST, \
+    AMO_CONFIG, FXASession, FileLock, cachepath, fxprofile, write_json_atomic
+from .cache import ResponseCache, UserCache
+from .policy import RequestPolicy
+from .stats import MeteredBody, RequestEvent
+from .cassette import RecordingAdapter, ReplayAdapter
+from .download import BlobStore
+
+# Hosts that get their own connection pool, see AmoSession.configure_pools
+POOL_HOSTS = (AMO_HOST, "reviewers." + AMO_HOST, AMO_INTERNAL_HOST)
+DEFAULT_POOL_SIZE = 10
+
+# Only cookies for these domains and their subdomains are imported from a Firefox profile
+FIREFOX_COOKIE_DOMAINS = (AMO_HOST, AMO_INTERNAL_HOST, "accounts.firefox.com")
+
+# Marks the caches as not opened yet
+UNSET = object()
+
+
+def _firefox_cookie_db_mtimes(dbpath):
+    mtimes = []
+    for path in (dbpath, dbpath + "-wal"):
+        try:
+            mtimes.append(os.stat(path).st_mtime_ns)
+        except FileNotFoundError:
+            mtimes.append(None)
+    return mtimes
+
+
+def _query_firefox_cookies(dbpath):
+    where = " OR ".join(["host = ? OR host LIKE ?"] * len(FIREFOX_COOKIE_DOMAINS))
+    params = []
+    for domain in FIREFOX_COOKIE_DOMAINS:
+        params.extend((domain, "%." + domain))
+
+    # Open the database in place. If Firefox is running and holds a lock on it, fall back to
+    # immutable mode which reads the database file without taking any locks.
+    def query(mode):
+        conn = sqlite3.connect("file:%s?%s" % (urllib.request.pathname2url(dbpath), mode), uri=True)
+        try:
+            return conn.execute("SELECT host, path, isSecure, expiry, name, value " +
+                                "FROM moz_cookies WHERE " + where, params).fetchall()
+        finally:
+            conn.close()
+
+    try:
+        return query("mode=ro")
+    except sqlite3.OperationalError:
+        return query("immutable=1")
+
+
+def read_firefox_cookies(profilepath):
+    # The AMO cookies are kept in the cache directory along with the mtimes of the database they
+    # were read from, so later runs only query the database again after Firefox has changed it.
+    dbpath = str(profilepath / "cookies.sqlite")
+    mtimes = _firefox_cookie_db_mtimes(dbpath)
+    jarpath = None
+    if AMO_CONFIG.get('pyamo', 'cache', 'enabled', fallback=True):
+        jarpath = cachepath("firefox-cookies-%s.json" %
+                            hashlib.sha1(dbpath.encode("utf-8")).hexdigest()[:16])
+
+    rows = None
+    if jarpath:
+        try:
+            with open(jarpath) as fd:
+                cached = json.load(fd)
+            if cached['mtimes'] == mtimes:
+                rows = cached['rows']
+        except (IOError, ValueError, KeyError):
+            pass
+
+    if rows is None:
+        rows = _query_firefox_cookies(dbpath)
+        if jarpath:
+            write_json_atomic(jarpath, {'mtimes': mtimes, 'rows': rows})
+
+    cookies = []
+    for host, path, secure, expiry, name, value in rows:
+        domain_spec = host.startswith('.')
+        cookies.append(http.cookiejar.Cookie(0, name, value,
+                                             None, False,
+                                             host, domain_spec, domain_spec,
+                                             path, False,
+                                             secure,
+                                             expiry, expiry == "",
+                                             None, None, {}))
+    return cookies
 
 
 class AmoSession(requests.Session):
@@ -25,51 +115,156 @@ class AmoSession(requests.Session):
         self.loginfail = 0
         self.timeout = None
         self.cookiefile = None
+        self.cookiefile_mtime = None
+        self.persisted_cookies = None
         self.firefox_cookies_profile = None
+        # The caches are opened on first use, so they are not created if they are turned off
+        self.cache_lock = threading.Lock()
+        self._cache = self._usercache = UNSET
+        self.blobs = BlobStore.from_config()
+        self.policy = RequestPolicy.from_config()
+
+        # Login recovery is single-flight: the first thread that notices an expired session logs
+        # in while holding the lock, the others wait and retry once the generation has changed.
+        self.login_lock = threading.Lock()
+        self.login_generation = 0
+        self.listeners = {'request_start': [], 'request_end': []}
+        self.cassette = None
+        self.poolsize = DEFAULT_POOL_SIZE
         super().__init__(*args, **kwargs)
+        self.configure_pools()
+
+    @property
+    def cache(self):
+        with self.cache_lock:
+            if self._cache is UNSET:
+                self._cache = ResponseCache.from_config()
+            return self._cache
+
+    @cache.setter
+    def cache(self, value):
+        self._cache = value
+
+    @property
+    def usercache(self):
+        with self.cache_lock:
+            if self._usercache is UNSET:
+                self._usercache = UserCache.from_config()
+            return self._usercache
+
+    @usercache.setter
+    def usercache(self, value):
+        self._usercache = value
+
+    def configure_pools(self, maxsize=DEFAULT_POOL_SIZE):
+        # Each host can be given a different pool size in the config, e.g.
+        # {"pyamo": {"pools": {"addons-internal.prod.mozaws.net": 4}}}
+        self.poolsize = maxsize
+        for host in POOL_HOSTS:
+            size = AMO_CONFIG.get('pyamo', 'pools', host, fallback=maxsize)
+            adapter = self.make_adapter(pool_connections=1, pool_maxsize=size)
+            self.mount("https://%s/" % host, adapter)
+
+    def make_adapter(self, **kwargs):
+        if not self.cassette:
+            return requests.adapters.HTTPAdapter(**kwargs)
+        elif self.cassette.replaying:
+            return ReplayAdapter(self.cassette, **kwargs)
+        else:
+            return RecordingAdapter(self.cassette, **kwargs)
+
+    def use_cassette(self, cassette):
+        # Record all traffic to the cassette, or replay it from there without network access
+        self.cassette = cassette
+        self.mount("https://", self.make_adapter())
+        self.mount("http://", self.make_adapter())
+        self.configure_pools(self.poolsize)
 
     def load_firefox_cookies(self, profile):
         self.cookiefile = None
         self.firefox_cookies_profile = profile
-        self.cookies = http.cookiejar.CookieJar()
-
-        with tempfile.TemporaryDirectory() as tempdir:
-            tempsql = os.path.join(tempdir, "cookies.sqlite")
-            shutil.copyfile(fxprofile(self.firefox_cookies_profile) / "cookies.sqlite", tempsql)
-            conn = sqlite3.connect(tempsql)
-            cursor = conn.cursor()
-            cursor.execute("SELECT host, path, isSecure, expiry, name, value FROM moz_cookies")
-            for item in cursor.fetchall():
-                domain_spec = item[0].startswith('.')
-                cookie = http.cookiejar.Cookie(0, item[4], item[5],
-                                               None, False,
-                                               item[0], domain_spec, domain_spec,
-                                               item[1], False,
-                                               item[2],
-                                               item[3], item[3] == "",
-                                               None, None, {})
-                self.cookies.set_cookie(cookie)
-            conn.close()
+        self.cookies = requests.cookies.RequestsCookieJar()
+
+        for cookie in read_firefox_cookies(fxprofile(self.firefox_cookies_profile)):
+            self.cookies.set_cookie(cookie)
 
     def load(self, cookiefile):
         self.firefox_cookies_profile = None
         self.cookiefile = cookiefile
         try:
             with open(cookiefile) as fdr:
+                self.cookiefile_mtime = os.fstat(fdr.fileno()).st_mtime_ns
                 try:
                     self.cookies = requests.utils.cookiejar_from_dict(json.load(fdr))
                 except Exception:  # pylint: disable=broad-except
-                    self.cookies = {}
+                    self.cookies = requests.cookies.RequestsCookieJar()
         except IOError:
-            pass
+            self.cookiefile_mtime = None
+
+        self.persisted_cookies = requests.utils.dict_from_cookiejar(self.cookies)
+
+    def cookiefile_changed(self):
+        try:
+            return os.stat(self.cookiefile).st_mtime_ns != self.cookiefile_mtime
+        except FileNotFoundError:
+            return False
 
     def persist(self):
-        if self.cookiefile:
-            mode = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
-            with os.fdopen(os.open(self.cookiefile, mode, 0o600), 'w') as fdr:
-                json.dump(requests.utils.dict_from_cookiejar(self.cookies), fdr)
+        if not self.cookiefile:
+            return
+
+        cookies = requests.utils.dict_from_cookiejar(self.cookies)
+        if cookies == self.persisted_cookies:
+            return
+
+        write_json_atomic(self.cookiefile, cookies)
+
+        self.persisted_cookies = cookies
+        self.cookiefile_mtime = os.stat(self.cookiefile).st_mtime_ns
+
+    def subscribe(self, event, callback):
+        # Events are "request_start" and "request_end", the callback receives a RequestEvent
+        self.listeners[event].append(callback)
+
+    def unsubscribe(self, event, callback):
+        self.listeners[event].remove(callback)
+
+    def emit(self, event, data):
+        for callback in self.listeners[event]:
+            callback(data)
 
     def request(self, method, url, **kwargs):  # pylint: disable=arguments-differ
+        event = RequestEvent(method, url)
+        self.emit('request_start', event)
+
+        try:
+            req = self.send_request(method, url, **kwargs)
+        except requests.exceptions.RequestException as e:
+            event.finish(e.response, error=e, size=0 if kwargs.get('stream') else None)
+            self.emit('request_end', event)
+            raise
+
+        if not self.listeners['request_end']:
+            # Nobody is measuring, leave the body alone
+            return req
+
+        # pylint: disable=protected-access
+        if kwargs.get('stream') and not req._content_consumed and hasattr(req.raw, 'read'):
+            # The request ends once the body has been read, measure it until then
+            event.response(req)
+
+            def body_read(size, error):
+                event.finish(error=error, size=size)
+                self.emit('request_end', event)
+
+            req.raw = MeteredBody(req.raw, body_read)
+            weakref.finalize(req, req.raw.end)
+        else:
+            event.finish(req)
+            self.emit('request_end', event)
+        return req
+
+    def send_request(self, method, url, **kwargs):
         if 'timeout' not in kwargs:
             if self.timeout:
                 kwargs['timeout'] = (self.timeout, self.timeout)
@@ -78,19 +273,64 @@ class AmoSession(requests.Session):
             else:
                 kwargs['timeout'] = (10.0, 10.0)
 
+        cachekey = cachettl = entry = None
+        if self.cache and method.upper() == 'GET':
+            fullurl = requests.Request(method, url, params=kwargs.get('params')).prepare().url
+            cachettl = self.cache.ttl(fullurl)
+            user = self.cookies.get('sessionid')
+            if cachettl is not None and user:
+                cachekey = self.cache.key(user, fullurl)
+                entry = self.cache.get(cachekey)
+
+        if entry and entry.fresh:
+            return entry.response()
+
+        if entry:
+            kwargs['headers'] = dict(kwargs.get('headers') or {}, **entry.validators())
+
         while True:
-            req = super().request(method, url, **kwargs)
+            generation = self.login_generation
+            req = self.policy.send(super().request, method, url, **kwargs)
             req.raise_for_status()
-            if self.check_login_succeeded(req):
-                return req
+            if self.check_login_succeeded(req, generation):
+                break
+
+        if entry and req.status_code == 304:
+            return self.cache.refresh(entry)
+        elif cachekey and req.status_code == 200:
+            if self.cache.storable(cachettl, req):
+                return self.cache.store(cachekey, cachettl, req)
+            elif entry:
+                self.cache.delete(cachekey)
+
+        return req
 
-    def check_login_succeeded(self, req):
+    def check_login_succeeded(self, req, generation=None):
         target_url = req.headers['location'] if req.status_code == 302 else req.url
         islogin = target_url.endswith("users/login") or "v1/authorization" in target_url
 
-        loginsuccess = False
+        if not islogin:
+            return True
+
+        with self.login_lock:
+            if generation is not None and generation != self.login_generation:
+                # Another thread has logged in while this request was in flight, just retry it.
+                return False
+
+            # Other amo processes using the same cookie file wait here while one of them logs in
+            with FileLock(self.cookiefile + ".lock") if self.cookiefile else nullcontext():
+                if self.cookiefile and self.cookiefile_changed():
+                    self.load(self.cookiefile)
+                else:
+                    self.relogin()
 
-        while islogin and not loginsuccess:
+            self.login_generation += 1
+
+        return False
+
+    def relogin(self):
+        loginsuccess = False
+        while not loginsuccess:
             if self.loginfail > 2 or not self.login_prompter:
                 raise requests.exceptions.HTTPError(401)
             self.loginfail += 1
@@ -100,7 +340,7 @@ class AmoSession(requests.Session):
             self.cookies.clear()
             loginsuccess = self.login()
 
-        return not islogin
+        self.persist()
 
     def login(self):
         login_url = '%s/accounts/login/start/?config=amo&to=/en-US/firefox/' % AMO_API_BASE
@@ -0,0 +1,174 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+# Portions Copyright (C) Philipp Kewisch, 2026
+
+import re
+import sys
+import time
+import threading
+
+from collections import defaultdict
+from urllib.parse import urlparse
+
+# Replace ids and slugs in urls so requests to the same endpoint are counted together
+ENDPOINT_PATTERNS = [
+    (re.compile(r'/(review-listed|review-unlisted|manage|user|file|downloads)/[^/]+'), r'/\1/:id'),
+    (re.compile(r'/addon/(?!manage/)[^/]+'), '/addon/:id'),
+    (re.compile(r'/\d+(?=/|$)'), '/:id'),
+]
+
+
+class RequestEvent:
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, method, url):
+        self.method = method.upper()
+        self.url = url
+        self.host = urlparse(url).hostname
+        self.start = time.monotonic()
+
+        self.status = None
+        self.bytes = 0
+        self.ttfb = None
+        self.elapsed = None
+        self.retries = 0
+        self.from_cache = False
+        self.error = None
+
+    def response(self, resp):
+        self.status = resp.status_code
+        self.retries = getattr(resp, 'retries', 0)
+        self.from_cache = getattr(resp, 'from_cache', False)
+        self.ttfb = 0 if self.from_cache else resp.elapsed.total_seconds()
+
+    def finish(self, resp=None, error=None, size=None):
+        self.elapsed = time.monotonic() - self.start
+        self.error = error
+
+        if resp is not None:
+            self.response(resp)
+        if size is not None:
+            self.bytes = size
+        elif resp is not None:
+            self.bytes = len(resp.content)
+
+    @property
+    def endpoint(self):
+        path = urlparse(self.url).path
+        for pattern, replacement in ENDPOINT_PATTERNS:
+            path = pattern.sub(replacement, path)
+        return "%s %s%s" % (self.method, self.host, path)
+
+
+class MeteredBody:
+    # Wraps the raw body of a streamed response. The request ends once the body has been read to
+    # the end, has failed or is closed, callback then gets the number of bytes read and the error.
+    # Other attributes are read from and written to the wrapped response, e.g. decode_content.
+
+    OWN_ATTRIBUTES = frozenset(('raw', 'callback', 'bytes', 'done'))
+
+    def __init__(self, raw, callback):
+        self.raw = raw
+        self.callback = callback
+        self.bytes = 0
+        self.done = False
+
+    def __getattr__(self, name):
+        if name in MeteredBody.OWN_ATTRIBUTES:
+            raise AttributeError(name)
+        return getattr(self.raw, name)
+
+    def __setattr__(self, name, value):
+        if name in MeteredBody.OWN_ATTRIBUTES:
+            super().__setattr__(name, value)
+        else:
+            setattr(self.raw, name, value)
+
+    def end(self, error=None):
+        if not self.done:
+            self.done = True
+            self.callback(self.bytes, error)
+
+    def read(self, amt=None, **kwargs):
+        try:
+            data = self.raw.read(amt, **kwargs)
+        except Exception as e:
+            self.end(e)
+            raise
+
+        self.bytes += len(data)
+        if not data and amt != 0:
+            self.end()
+        return data
+
+    def readinto(self, buf):
+        try:
+            count = self.raw.readinto(buf)
+        except Exception as e:
+            self.end(e)
+            raise
+
+        self.bytes += count
+        if not count and len(buf):
+            self.end()
+        return count
+
+    def stream(self, amt=2 ** 16, decode_content=None):
+        # urllib3's stream() would read from the wrapped response directly
+        while True:
+            data = self.read(amt, decode_content=decode_content)
+            if not data:
+                break
+            yield data
+
+    def release_conn(self):
+        self.end()
+        self.raw.release_conn()
+
+    def close(self):
+        self.end()
+        self.raw.close()
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = max(0, int(round(pct / 100.0 * len(ordered))) - 1)
+    return ordered[index]
+
+
+class RequestStats:
+    def __init__(self):
+        self.events = defaultdict(list)
+        self.lock = threading.RLock()
+
+    def attach(self, session):
+        session.subscribe('request_end', self.record)
+
+    def record(self, event):
+        with self.lock:
+            self.events[event.endpoint].append(event)
+
+    def summary(self):
+        lines = ["%-70s %5s %4s %4s %4s %10s %8s %8s %8s %8s" % (
+            "Endpoint", "Count", "Err", "Hit", "Rtry", "Bytes", "TTFB", "p50", "p90", "p99"
+        )]
+
+        for endpoint, events in sorted(self.events.items()):
+            times = [event.elapsed for event in events]
+            ttfbs = [event.ttfb for event in events if event.ttfb is not None]
+            lines.append("%-70s %5d %4d %4d %4d %10d %8.3f %8.3f %8.3f %8.3f" % (
+                endpoint[:70], len(events),
+                sum(1 for event in events if event.error or (event.status or 0) >= 400),
+                sum(1 for event in events if event.from_cache),
+                sum(event.retries for event in events),
+                sum(event.bytes for event in events),
+                sum(ttfbs) / len(ttfbs) if ttfbs else 0,
+                percentile(times, 50), percentile(times, 90), percentile(times, 99)
+            ))
+
+        return "\n".join(lines)
+
+    def print_summary(self, fd=sys.stderr):
+        if self.events:
+            print(self.summary(), file=fd)
@@ -3,8 +3,7 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 # Portions Copyright (C) Philipp Kewisch, 2021
 
-import lxml.html
-from .utils import AMO_BASE, AMO_USER_BASE, csspath
+from .utils import AMO_BASE, AMO_USER_BASE, HTMLStream, has_class
 
 
 class User:
@@ -12,22 +11,29 @@ class User:
 
     @staticmethod
     def getcache(parent, id_or_url, expand=False):
-        user = User(parent, id_or_url)
-        if user.userid not in User._cache:
-            User._cache[user.userid] = user
+        userid = User.parse_id(id_or_url)
+        user = User._cache.get(userid)
+        if not user:
+            user = User._cache.setdefault(userid, User(parent, userid))
+            if parent.session.usercache:
+                user.email = parent.session.usercache.get(userid)
 
         if expand:
             user.get()
 
-        return User._cache[user.userid]
+        return user
 
-    def __init__(self, parent, id_or_url):
+    @staticmethod
+    def parse_id(id_or_url):
         id_or_url = str(id_or_url)
         if id_or_url.startswith(AMO_BASE) or id_or_url.startswith(AMO_USER_BASE):
-            userid = id_or_url.split("/")[-1]
+            return id_or_url.split("/")[-1]
         else:
             # Strip slashes, sometimes added due to bash directory completion
-            userid = id_or_url.rstrip('/')
+            return id_or_url.rstrip('/')
+
+    def __init__(self, parent, id_or_url):
+        userid = User.parse_id(id_or_url)
 
         self.parent = parent
         self.session = parent.session
@@ -36,14 +42,26 @@ class User:
 
         self.url = '%s/%s/edit' % (AMO_USER_BASE, userid)
 
+    def invalidate(self):
+        self.email = None
+        if self.session.usercache:
+            self.session.usercache.invalidate([self.userid])
+
     def get(self):
         if self.email:
             return self
 
         req = self.session.get(self.url, stream=True)
 
-        req.raw.decode_content = True
-        doc = lxml.html.parse(req.raw).getroot()
-        self.email = doc.xpath(csspath(".UserProfileEdit-email"))[0].attrib['value']
+        # The email is near the top of the page, no need to read the rest
+        with HTMLStream(req, tag='input') as stream:
+            node = stream.find(lambda elem: has_class(elem, 'UserProfileEdit-email'))
+
+        if node is None:
+            raise Exception("Could not find email for user %s" % self.userid)
+
+        self.email = node.attrib['value']
+        if self.session.usercache:
+            self.session.usercache.store(self.userid, self.email)
 
         return self
@@ -8,17 +8,35 @@ import re
 import sys
 import json
 import argparse
+import tempfile
+import threading
 import pathlib
 
+from urllib.parse import urlparse, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+
 from pytz import timezone
 from mozrunner import FirefoxRunner
 
 import requests
 import cssselect
+import lxml.etree
+import lxml.html
 import fxa.core
 import fxa.oauth
 import fxa.errors
 
+# File locks use fcntl on posix and msvcrt on Windows
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import msvcrt  # pylint: disable=import-error
+except ImportError:
+    msvcrt = None
+
 # set AMO_HOST=adddons.allizom.org to use staging
 AMO_HOST = os.environ.get('AMO_HOST', 'addons.mozilla.org')
 AMO_INTERNAL_HOST = os.environ.get('AMO_HOST', 'addons-internal.prod.mozaws.net')
@@ -34,6 +52,11 @@ AMO_ADMIN_BASE = '%s/admin' % AMO_INTERNAL_BASE
 AMO_DEVELOPER_BASE = '%s/developers' % AMO_BASE
 AMO_TIMEZONE = timezone("America/Los_Angeles")
 
+if sys.platform.startswith("win"):
+    DEFAULT_CACHE_DIR = os.path.join(os.environ.get("LOCALAPPDATA", "~"), "pyamo", "cache")
+else:
+    DEFAULT_CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME", "~/.cache"), "pyamo")
+
 VALIDATION_WAIT = 5
 RE_VERSION = re.compile(r"""(?P<major>\d+|\*)      # major (x in x.y)
                             \.(?P<minor1>\d+|\*)? # minor1 (y in x.y)
@@ -119,6 +142,118 @@ def csspath(query):
     return cssselect.HTMLTranslator().css_to_xpath(query)
 
 
+class Selectors:
+    # A set of named selectors, each compiled to an lxml XPath object on first use. The values are
+    # css selectors, or a tuple of css selector (or None) and an xpath expression to append. The
+    # xpath may contain variables, e.g. SELECTORS.name(doc, version="1.0"). An XPath object only
+    # evaluates one document at a time, so each thread compiles its own.
+
+    def __init__(self, **queries):
+        self._queries = queries
+        self._xpaths = {}
+        self._local = threading.local()
+
+    def xpath(self, name):
+        if name not in self._xpaths:
+            query = self._queries[name]
+            if isinstance(query, tuple):
+                css, suffix = query
+                query = (csspath(css) if css else "") + suffix
+            else:
+                query = csspath(query)
+            self._xpaths[name] = query
+        return self._xpaths[name]
+
+    def __getattr__(self, name):
+        if name.startswith("_") or name not in self._queries:
+            raise AttributeError(name)
+
+        compiled = getattr(self._local, name, None)
+        if compiled is None:
+            compiled = lxml.etree.XPath(self.xpath(name))
+            setattr(self._local, name, compiled)
+        return compiled
+
+
+def parallel_map(func, items, jobs=1):
+    # Like map(), but runs up to `jobs` calls at once. Results are yielded in the original order.
+    if jobs <= 1:
+        yield from map(func, items)
+        return
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        yield from executor.map(func, items)
+
+
+class HTMLStream:
+    # Parses an html response while it is being downloaded. Elements can be processed as soon as
+    # their end tag arrives, and callers that have what they need can close the stream early
+    # instead of reading the rest of the page.
+
+    def __init__(self, response, tag=None, chunksize=16384):
+        self.response = response
+        self.chunks = response.iter_content(chunksize)
+        self.root = None
+
+        self.parser = lxml.etree.HTMLPullParser(events=('end',), tag=tag)
+        self.parser.set_element_class_lookup(lxml.html.HtmlElementClassLookup())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def iterfind(self, match=None):
+        # Yields elements with the tag given to the constructor that match the predicate
+        while self.root is None:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                self.root = self.parser.close()
+            else:
+                self.parser.feed(chunk)
+
+            for _, elem in self.parser.read_events():
+                if not match or match(elem):
+                    yield elem
+
+    def find(self, match=None):
+        return next(self.iterfind(match), None)
+
+    def finish(self):
+        # Reads and parses the rest of the document, returning the root element
+        for _ in self.iterfind(lambda elem: False):
+            pass
+        return self.root
+
+    def close(self):
+        self.response.close()
+
+
+def parent_matches(elem, *match):
+    # Checks the tag and id of the element's ancestors, e.g. ("tbody", None), (None, "addon-queue")
+    for tag, elemid in match:
+        elem = elem.getparent()
+        if elem is None or (tag and elem.tag != tag) or (elemid and elem.get('id') != elemid):
+            return False
+    return True
+
+
+def has_class(elem, name):
+    return name in (elem.get('class') or "").split()
+
+
+def page_count(links):
+    # The highest page linked from a pagination block, or None if there are no page links
+    pages = []
+    for link in links:
+        page = parse_qs(urlparse(link.get('href', '')).query).get('page', [''])[0]
+        if page.isdigit():
+            pages.append(int(page))
+    return max(pages) if pages else None
+
+
 def flagstr(obj, name, altname=None):
     if name in obj and obj[name]:
         return "[%s]" % (altname or name)
@@ -164,6 +299,37 @@ class FXASession:
         return self.oauth_client.authorize_code(self.session, self.scope, self.client_id)
 
 
+class FileLock:
+    # An exclusive lock on a file, shared between processes
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def __enter__(self):
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        if fcntl:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        else:
+            while True:
+                try:
+                    msvcrt.locking(self.fd, msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if fcntl:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        else:
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            msvcrt.locking(self.fd, msvcrt.LK_UNLCK, 1)
+        os.close(self.fd)
+        self.fd = None
+        return False
+
+
 def requiresvpn(func):
     def wrapper(*args, **kwargs):
         try:
@@ -202,6 +368,25 @@ class AmoConfigParser:
 AMO_CONFIG = AmoConfigParser()
 
 
+def cachepath(*parts):
+    cachedir = os.path.expanduser(AMO_CONFIG.get('pyamo', 'cachedir', fallback=DEFAULT_CACHE_DIR))
+    os.makedirs(cachedir, exist_ok=True)
+    return os.path.join(cachedir, *parts)
+
+
+def write_json_atomic(path, data):
+    # Write to a temporary file and rename, so other processes never see a partial file
+    fd, temppath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                    prefix=os.path.basename(path) + ".")
+    try:
+        with os.fdopen(fd, 'w') as fdr:
+            json.dump(data, fdr)
+        os.replace(temppath, path)
+    except BaseException:
+        os.unlink(temppath)
+        raise
+
+
 def handler_defaults(handler, cmd):
     # Read the defaults from the config file, if it does not exist just parse
     # options as usual.
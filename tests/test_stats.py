@@ -0,0 +1,71 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+# Portions Copyright (C) Philipp Kewisch, 2026
+
+import io
+import os
+import gzip
+import tempfile
+import unittest
+
+import lxml.html
+import urllib3
+
+# pyamo reads its config when imported, give it an empty one
+HOME = tempfile.mkdtemp()
+for configname in (".amorc", "amorc.json"):
+    with open(os.path.join(HOME, configname), "w") as fd:
+        fd.write("{}")
+os.environ["HOME"] = os.environ["USERPROFILE"] = HOME
+
+from pyamo.stats import MeteredBody  # noqa: E402 pylint: disable=wrong-import-position
+
+PAGE = b"<html><body><div id='addon' data-id='42'>" + b"x" * 100000 + b"</div></body></html>"
+
+
+def gzip_response(body):
+    data = gzip.compress(body)
+    return urllib3.HTTPResponse(
+        body=io.BytesIO(data),
+        headers={'Content-Encoding': 'gzip', 'Content-Length': str(len(data))},
+        status=200,
+        preload_content=False,
+        decode_content=False
+    )
+
+
+class MeteredBodyTest(unittest.TestCase):
+    def setUp(self):
+        self.ended = []
+
+    def metered(self, raw):
+        return MeteredBody(raw, lambda size, error: self.ended.append((size, error)))
+
+    def test_decode_content_is_passed_through(self):
+        raw = gzip_response(PAGE)
+        body = self.metered(raw)
+        body.decode_content = True
+
+        self.assertTrue(raw.decode_content)
+        doc = lxml.html.parse(body).getroot()
+        self.assertEqual(doc.get_element_by_id('addon').get('data-id'), '42')
+        self.assertEqual(self.ended, [(len(PAGE), None)])
+
+    def test_stream_counts_decoded_bytes(self):
+        body = self.metered(gzip_response(PAGE))
+        data = b''.join(body.stream(16384, decode_content=True))
+
+        self.assertEqual(data, PAGE)
+        self.assertEqual(self.ended, [(len(PAGE), None)])
+
+    def test_close_ends_once(self):
+        body = self.metered(gzip_response(PAGE))
+        body.close()
+        body.close()
+
+        self.assertEqual(self.ended, [(0, None)])
+
+
+if __name__ == '__main__':
+    unittest.main()